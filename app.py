@@ -1,16 +1,31 @@
+# pandas・gspread・oauth2client は読み込みに時間がかかるため、使う関数の中で import する
+# （ワーカーの起動やテストでの import を速くするため。bench/import_time.py で確認できる）
 import os
 import sqlite3
-import pandas as pd
 from datetime import datetime
-from flask import Flask, request, render_template, redirect, url_for, jsonify, send_file
+from flask import (
+    Flask, request, render_template, redirect, url_for, jsonify, send_file, g, has_request_context, Response,
+    stream_with_context
+)
 from werkzeug.utils import secure_filename
+import click
 import hashlib
-import traceback
 import io
-from openpyxl import load_workbook
+import logging
 import re
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import csv
+import codecs
+import zipfile
+import atexit
+import functools
+import contextlib
+import tempfile
+import unicodedata
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+import random
+import threading
+import time
 import json
 from dotenv import load_dotenv
 
@@ -21,70 +36,642 @@ app = Flask(__name__)
 # CSVアップロード機能用の設定
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DATABASE'] = 'database.db'
+# SQLiteの接続設定（cache_size は負の値でKiB単位、mmap_size はバイト単位）
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -16000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+app.config['SQLITE_STATEMENT_CACHE_SIZE'] = 256
 app.config['ALLOWED_EXTENSIONS'] = {'csv'}
+# CSVを分割して読み込む際の1チャンクあたりの行数
+app.config['CSV_CHUNK_SIZE'] = int(os.environ.get('CSV_CHUNK_SIZE', 20000))
+# /data の1ページあたりの表示件数（limit パラメータの上限）
+app.config['DATA_PAGE_SIZE'] = 100
+app.config['DATA_PAGE_SIZE_MAX'] = 1000
+# エクスポート時に SQLite のカーソルから一度に取り出す行数
+app.config['EXPORT_FETCH_SIZE'] = 1000
+# アップロードファイルを読み書き・ハッシュ計算する際の1回あたりのバイト数
+app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024
+# 一括アップロードで受け付ける拡張子と、CSV解析に使うプロセス数
+app.config['BATCH_ALLOWED_EXTENSIONS'] = {'csv', 'zip'}
+# zip内のファイルの展開後の合計サイズの上限（これを超えるzipは展開せずに拒否する）
+app.config['ZIP_MAX_UNCOMPRESSED_BYTES'] = int(os.environ.get('ZIP_MAX_UNCOMPRESSED_BYTES', 512 * 1024 * 1024))
+app.config['UPLOAD_PARSE_WORKERS'] = int(os.environ.get('UPLOAD_PARSE_WORKERS', os.cpu_count() or 1))
+# 並列に解析するのは、ファイルの合計サイズがこれ以上の場合だけ（小さいファイルは1プロセスで順に解析する方が速い）
+app.config['UPLOAD_PARALLEL_MIN_BYTES'] = int(os.environ.get('UPLOAD_PARALLEL_MIN_BYTES', 16 * 1024 * 1024))
+# Googleスプレッドシート用の設定
+app.config['SPREADSHEET_NAME'] = '【開発用】シードル出庫台帳'
+# アクセストークンの有効期限（60分）が切れる前に再認証する間隔（秒）
+app.config['SHEETS_REAUTH_INTERVAL'] = int(os.environ.get('SHEETS_REAUTH_INTERVAL', 50 * 60))
+# 一括書き込み1回あたりの最大行数と、クォータ超過時の最大再試行回数
+app.config['SHEETS_WRITE_CHUNK_SIZE'] = 500
+app.config['SHEETS_MAX_RETRIES'] = 5
+# スプレッドシート反映ジョブの最大試行回数・ポーリング間隔（秒）・処理中とみなす時間（秒。チャンクを追記するたびに延ばす）
+app.config['SYNC_JOB_MAX_ATTEMPTS'] = 8
+app.config['SYNC_JOB_POLL_INTERVAL'] = 2.0
+app.config['SYNC_JOB_LEASE_SECONDS'] = 300
+# False にするとこのプロセスではジョブを処理しない（ジョブは積まれたまま他のプロセスが処理する）
+app.config['SYNC_WORKER_ENABLED'] = os.environ.get('SYNC_WORKER_ENABLED', '1') != '0'
+# 出庫情報・出庫詳細シートのローカルミラー（SQLite）を再取得するまでの秒数
+app.config['SHEETS_MIRROR_TTL'] = int(os.environ.get('SHEETS_MIRROR_TTL', 300))
+# 出庫シートの行番号が変わる書き込みのロック（プロセス間）を保持できる秒数と、取得を待つ最大秒数
+app.config['SHEETS_WRITE_LOCK_SECONDS'] = 300
+app.config['SHEETS_WRITE_LOCK_TIMEOUT'] = 60
+# /list の1ページあたりの件数（既定値と上限）
+app.config['LIST_PAGE_SIZE'] = 50
+app.config['LIST_PAGE_SIZE_MAX'] = 500
+# 出庫詳細の編集画面に追加用として表示する空欄の行数
+app.config['EDIT_DETAIL_BLANK_LINES'] = 3
+# プルダウン用マスタデータ（出庫先・商品名・スタッフ）を取り直すまでの秒数と、キャッシュの保存先
+app.config['MASTER_DATA_TTL'] = int(os.environ.get('MASTER_DATA_TTL', 600))
+app.config['MASTER_DATA_CACHE_FILE'] = os.environ.get('MASTER_DATA_CACHE_FILE', 'master_data_cache.json')
+
+# ログの出力レベル（DEBUG にするとCSV処理の途中経過なども出力する）
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 処理時間の計測（/metrics）と、レスポンスへの Server-Timing ヘッダーの付与
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+app.config['TIMING_HEADER'] = os.environ.get('TIMING_HEADER', '0') == '1'
 
 # アップロード用フォルダの作成
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+logging.basicConfig(
+    level=app.config['LOG_LEVEL'],
+    format='%(asctime)s %(levelname)s [%(name)s] pid=%(process)d thread=%(threadName)s %(message)s'
+)
+logger = logging.getLogger('inventory')
+
+
+# --- 処理時間の計測 ---
+# ルート・Sheets API・SQLite・pandas の各処理時間をプロセス内のヒストグラムに集計し、
+# /metrics から Prometheus のテキスト形式で返す（gunicorn ではワーカーごとの値になる）。
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    'http_request_duration_seconds': 'ルートごとのリクエスト処理時間',
+    'sheets_api_request_duration_seconds': 'Google Sheets / Drive API の呼び出し時間',
+    'sheets_api_requests_total': 'Google Sheets / Drive API の呼び出し回数',
+    'sheets_api_quota_errors_total': 'Google Sheets API のクォータ超過（429）の回数',
+    'sheets_api_retries_total': 'Google Sheets API の再試行回数',
+    'sqlite_query_duration_seconds': 'SQLite の SQL 文の実行時間',
+    'pandas_stage_duration_seconds': 'CSV取り込みの pandas 処理の各段階の時間',
+}
+# Server-Timing ヘッダーに出す内訳（ヒストグラム名 → ヘッダー上の名前）
+REQUEST_TIMING_NAMES = {
+    'sheets_api_request_duration_seconds': 'sheets',
+    'sqlite_query_duration_seconds': 'sqlite',
+    'pandas_stage_duration_seconds': 'pandas',
+}
+
+_metrics_lock = threading.Lock()
+_histograms = defaultdict(dict)
+_counters = defaultdict(dict)
+
+
+def observe(name, seconds, **labels):
+    """ヒストグラムに処理時間を1件記録する（リクエスト中なら Server-Timing の内訳にも加える）"""
+    if not app.config['METRICS_ENABLED']:
+        return
+    key = tuple(sorted(labels.items()))
+    with _metrics_lock:
+        series = _histograms[name].get(key)
+        if series is None:
+            series = _histograms[name][key] = {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                series['buckets'][index] += 1
+        series['sum'] += seconds
+        series['count'] += 1
+    timing_name = REQUEST_TIMING_NAMES.get(name)
+    if timing_name and has_request_context() and 'request_timings' in g:
+        g.request_timings[timing_name] += seconds
+
+
+def inc_counter(name, amount=1, **labels):
+    if not app.config['METRICS_ENABLED']:
+        return
+    key = tuple(sorted(labels.items()))
+    with _metrics_lock:
+        _counters[name][key] = _counters[name].get(key, 0) + amount
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """with ブロックの処理時間をヒストグラムに記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render_metrics():
+    """集計した値を Prometheus のテキスト形式にする"""
+    lines = []
+    with _metrics_lock:
+        for name, series_by_labels in sorted(_counters.items()):
+            lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in sorted(series_by_labels.items()):
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        for name, series_by_labels in sorted(_histograms.items()):
+            lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, series in sorted(series_by_labels.items()):
+                for bound, count in zip(METRIC_BUCKETS, series['buckets']):
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {series["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {series["sum"]:.6f}')
+                lines.append(f'{name}_count{_format_labels(labels)} {series["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def sheets_api_name(url):
+    """Sheets / Drive API の URL から、メトリクスのラベルにする操作名を取り出す（IDや範囲は含めない）"""
+    parsed = urlparse(url)
+    if 'drive' in parsed.netloc or parsed.path.startswith('/drive'):
+        return 'drive'
+    match = re.search(r'/spreadsheets/[^/:]+(.*)$', parsed.path)
+    if not match:
+        return 'other'
+    rest = match.group(1)
+    if rest.startswith(':'):
+        return rest[1:]
+    if rest.startswith('/values'):
+        last = rest.rsplit('/', 1)[-1]
+        return 'values:' + (last.rsplit(':', 1)[1] if ':' in last else 'get')
+    return 'get'
+
+
+def _record_sheets_response(response, *args, **kwargs):
+    """requests のレスポンスフックとして、Sheets API 呼び出しの回数・時間・クォータ超過を記録する"""
+    api = sheets_api_name(response.url)
+    observe('sheets_api_request_duration_seconds', response.elapsed.total_seconds(),
+            api=api, method=response.request.method)
+    inc_counter('sheets_api_requests_total', api=api, status=response.status_code)
+    if response.status_code == 429:
+        inc_counter('sheets_api_quota_errors_total', api=api)
+
+
+def instrument_sheets_client(client):
+    """gspread クライアントの HTTP セッションに計測用のフックを付ける"""
+    session = getattr(getattr(client, 'http_client', None), 'session', None)
+    hooks = getattr(session, 'hooks', None)
+    if hooks is not None:
+        hooks.setdefault('response', []).append(_record_sheets_response)
+
+
+def _statement_kind(sql):
+    """SQL文の種類（SELECT / INSERT など）。メトリクスのラベルに使う"""
+    head = sql.lstrip()[:16].split(None, 1)
+    return head[0].upper() if head else ''
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """execute / executemany の実行時間を記録する接続"""
+
+    def execute(self, sql, parameters=()):
+        with timed('sqlite_query_duration_seconds', statement=_statement_kind(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        with timed('sqlite_query_duration_seconds', statement=_statement_kind(sql)):
+            return super().executemany(sql, parameters)
+
 
 # --- 2. ヘルパー関数 ---
 
 # Googleスプレッドシートへの接続
+# 認証・スプレッドシートのオープンはプロセス全体で一度だけ行い、
+# 以降のリクエスト（gunicornの各スレッド）では同じクライアントとワークシートを使い回す
+
+SHEETS_SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+_sheets_lock = threading.RLock()
+_sheets_session = {
+    'client': None,
+    'spreadsheet': None,
+    'worksheets': {},
+    'authorized_at': 0.0,
+}
+sheets_stats = {
+    'hits': 0,
+    'misses': 0,
+    'auth_count': 0,
+    'auth_seconds_total': 0.0,
+    'auth_seconds_last': 0.0,
+}
+
+
+def load_google_credentials():
+    """環境変数 GOOGLE_CREDENTIALS_JSON（JSON文字列またはファイルパス）から認証情報を作成する"""
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    value = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+    if not value:
+        raise RuntimeError('環境変数 GOOGLE_CREDENTIALS_JSON が設定されていません')
+    if value.lstrip().startswith('{'):
+        creds_dict = json.loads(value)
+    else:
+        with open(value, encoding='utf-8') as f:
+            creds_dict = json.load(f)
+    return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SHEETS_SCOPE)
+
+
+def _authorize_sheets():
+    """認証してスプレッドシートを開き直す（_sheets_lock を保持した状態で呼ぶこと）"""
+    import gspread
+
+    started = time.perf_counter()
+    client = gspread.authorize(load_google_credentials())
+    instrument_sheets_client(client)
+    spreadsheet = client.open(app.config['SPREADSHEET_NAME'])
+    elapsed = time.perf_counter() - started
+
+    _sheets_session['client'] = client
+    _sheets_session['spreadsheet'] = spreadsheet
+    _sheets_session['worksheets'] = {}
+    _sheets_session['authorized_at'] = time.monotonic()
+    sheets_stats['auth_count'] += 1
+    sheets_stats['auth_seconds_total'] += elapsed
+    sheets_stats['auth_seconds_last'] = elapsed
+
+
+def get_spreadsheet():
+    """共有のスプレッドシートを取得する（トークン期限前なら再認証する）"""
+    with _sheets_lock:
+        age = time.monotonic() - _sheets_session['authorized_at']
+        if _sheets_session['spreadsheet'] is None or age >= app.config['SHEETS_REAUTH_INTERVAL']:
+            _authorize_sheets()
+        return _sheets_session['spreadsheet']
+
+
+def get_worksheet(sheet_name):
+    """共有のワークシートを取得する（一度開いたシートはキャッシュから返す）"""
+    with _sheets_lock:
+        spreadsheet = get_spreadsheet()
+        worksheet = _sheets_session['worksheets'].get(sheet_name)
+        if worksheet is not None:
+            sheets_stats['hits'] += 1
+            return worksheet
+        sheets_stats['misses'] += 1
+        worksheet = spreadsheet.worksheet(sheet_name)
+        _sheets_session['worksheets'][sheet_name] = worksheet
+        return worksheet
+
+
+def reset_sheets_session():
+    """共有セッションを破棄する（次回アクセス時に再認証される）"""
+    with _sheets_lock:
+        _sheets_session['client'] = None
+        _sheets_session['spreadsheet'] = None
+        _sheets_session['worksheets'] = {}
+        _sheets_session['authorized_at'] = 0.0
+
+
+def get_sheets_stats():
+    """共有セッションのキャッシュヒット数・認証回数・認証にかかった時間を返す"""
+    with _sheets_lock:
+        stats = dict(sheets_stats)
+        stats['session_age_seconds'] = (
+            time.monotonic() - _sheets_session['authorized_at']
+            if _sheets_session['spreadsheet'] is not None else None
+        )
+        stats['cached_worksheets'] = sorted(_sheets_session['worksheets'])
+    return stats
+
 
 def connect_sheets():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    json_content = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-    creds_dict = json.loads(json_content)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    sheet = client.open('【開発用】シードル出庫台帳')
-    return sheet.worksheet('出庫情報'), sheet.worksheet('出庫詳細')
+    return get_worksheet('出庫情報'), get_worksheet('出庫詳細')
+
+
+# Sheets APIの書き込み（クォータ超過時の再試行つき）
+
+def api_error_status(error):
+    """gspread の APIError から HTTP ステータスコードを取り出す"""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def backoff_wait(attempt, status):
+    """再試行までの待ち時間（指数バックオフ）だけ待つ"""
+    wait = min(2 ** attempt, 32) + random.random()
+    inc_counter('sheets_api_retries_total', status=status)
+    logger.warning("Sheets APIの一時的なエラー（%s）のため %.1f 秒後に再試行します", status, wait)
+    time.sleep(wait)
+
+
+def call_with_backoff(func, *args, retry_server_errors=True, **kwargs):
+    """クォータ超過（429）やサーバーエラー（5xx）の場合に指数バックオフで再試行する
+
+    行の追記・挿入・削除のように、2回実行すると結果が変わる呼び出しでは retry_server_errors=False にする。
+    5xx でも実際には反映されていることがあるため、再試行してよいのは 429 だけになる。
+    """
+    import gspread
+
+    max_retries = app.config['SHEETS_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = api_error_status(e)
+            retryable = status == 429 or (retry_server_errors and status is not None and status >= 500)
+            if not retryable or attempt == max_retries:
+                raise
+            backoff_wait(attempt, status)
+
+
+def append_rows_in_chunks(worksheet, rows, value_input_option='RAW', on_chunk=None):
+    """行をまとめて append_rows で追記する（大量の場合は分割）
+
+    value_input_option は gspread と同じく既定で RAW（出庫日などを文字列のまま書き込み、
+    ミラーや一覧の絞り込みで ISO 形式の文字列として比べられるようにする）。
+    追記された各行のシート上の行番号のリストを返す（レスポンスから判別できない行は None）。
+    on_chunk を渡すと、チャンクを追記するたびにそのチャンクの行番号のリストで呼ぶ。
+    """
+    chunk_size = app.config['SHEETS_WRITE_CHUNK_SIZE']
+    row_numbers = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        first_row = append_chunk(worksheet, chunk, value_input_option)
+        if first_row is None:
+            chunk_row_numbers = [None] * len(chunk)
+        else:
+            chunk_row_numbers = list(range(first_row, first_row + len(chunk)))
+        row_numbers.extend(chunk_row_numbers)
+        if on_chunk is not None:
+            on_chunk(chunk_row_numbers)
+    return row_numbers
+
+
+def append_chunk(worksheet, chunk, value_input_option):
+    """1チャンク分を append_rows で追記し、追記先の先頭行番号を返す（分からなければ None）
+
+    5xx の場合は追記されていることがあるので、A列（出庫ID）にこのチャンクの行が並んでいるかを
+    確かめ、追記されていなければ再試行する（同じ行を二重に追記しない）。
+    """
+    import gspread
+
+    max_retries = app.config['SHEETS_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        try:
+            response = call_with_backoff(
+                worksheet.append_rows, chunk, value_input_option=value_input_option, retry_server_errors=False
+            )
+            return parse_updated_first_row(response)
+        except gspread.exceptions.APIError as e:
+            status = api_error_status(e)
+            if status is None or status < 500 or attempt == max_retries:
+                raise
+            first_row = find_appended_chunk(worksheet, chunk)
+            if first_row is not None:
+                logger.warning("Sheets APIがエラー（%s）を返しましたが、行は追記されていました", status)
+                return first_row
+            backoff_wait(attempt, status)
+
+
+def find_appended_chunk(worksheet, chunk):
+    """A列の末尾から、チャンクの出庫IDの並びを探して先頭の行番号を返す（見つからなければ None）
+
+    追記する行の出庫IDはジョブごとに払い出した新しいIDなので、並びが見つかれば追記済みとみなせる。
+    """
+    ids = [str(row[0]) for row in chunk]
+    column = call_with_backoff(worksheet.col_values, 1)
+    for start in range(len(column) - len(ids), -1, -1):
+        if column[start:start + len(ids)] == ids:
+            return start + 1
+    return None
+
+
+def parse_updated_first_row(response):
+    """append系APIのレスポンス（updates.updatedRange）から追記先の先頭行番号を取り出す"""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+# --- プルダウン用マスタデータのキャッシュ ---
+# 出庫先・商品名・スタッフのシートはめったに変わらないため、プロセス内とディスクにキャッシュする。
+# 期限切れ後は古い値をそのまま返しつつ、バックグラウンドで取り直す（stale-while-revalidate）。
+
+MASTER_DATA_SHEETS = ('出庫先', '商品名', 'スタッフ')
+
+_master_data = {'values': None, 'fetched_at': 0.0, 'version': None, 'disk_loaded': False, 'refreshing': False}
+_master_data_lock = threading.Lock()
+
+
+def fetch_master_data():
+    """マスタシートの1列目（ヘッダーを除く）を一度の API 呼び出しでまとめて取得する"""
+    spreadsheet = get_spreadsheet()
+    response = call_with_backoff(
+        spreadsheet.values_batch_get, [f"'{name}'!A2:A" for name in MASTER_DATA_SHEETS]
+    )
+    value_ranges = response.get('valueRanges', [])
+    values = {}
+    for index, name in enumerate(MASTER_DATA_SHEETS):
+        rows = value_ranges[index].get('values', []) if index < len(value_ranges) else []
+        values[name] = [row[0] if row else '' for row in rows]
+    return values
+
+
+def load_master_data_file():
+    """ディスクに保存したマスタデータを読み込む（無い・壊れている場合は None）"""
+    try:
+        with open(app.config['MASTER_DATA_CACHE_FILE'], encoding='utf-8') as f:
+            cached = json.load(f)
+        return cached if set(MASTER_DATA_SHEETS) <= set(cached.get('values', {})) else None
+    except (OSError, ValueError):
+        return None
+
+
+def store_master_data(values, version):
+    """取得したマスタデータをプロセス内のキャッシュとディスクに保存する"""
+    fetched_at = time.time()
+    with _master_data_lock:
+        _master_data['values'] = values
+        _master_data['fetched_at'] = fetched_at
+        _master_data['version'] = version
+    path = app.config['MASTER_DATA_CACHE_FILE']
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'values': values, 'fetched_at': fetched_at, 'version': version}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error("マスタデータのキャッシュをディスクに保存できませんでした: %s", e)
+
+
+def _refresh_master_data_in_background(version):
+    try:
+        store_master_data(fetch_master_data(), version)
+        logger.info("プルダウン用マスタデータを更新しました")
+    except Exception as e:
+        logger.error("プルダウン用マスタデータの更新に失敗しました（古い値を使い続けます）: %s", e)
+    finally:
+        with _master_data_lock:
+            _master_data['refreshing'] = False
+
+
+def get_master_data():
+    """プルダウン用マスタデータ {シート名: 選択肢のリスト} を返す
+
+    キャッシュがあれば即座に返し、期限（MASTER_DATA_TTL）切れならバックグラウンドで取り直す。
+    キャッシュが無いか /master-data/invalidate で無効化された場合だけ、その場でシートから取得する。
+    """
+    version = get_cache_version(get_db(), 'master_data')
+    with _master_data_lock:
+        if not _master_data['disk_loaded']:
+            # 起動直後のワーカーは前回ディスクに保存した値から始める
+            _master_data['disk_loaded'] = True
+            cached = load_master_data_file()
+            if cached is not None and _master_data['values'] is None:
+                _master_data['values'] = cached['values']
+                _master_data['fetched_at'] = cached.get('fetched_at', 0.0)
+                _master_data['version'] = cached.get('version')
+
+        if _master_data['values'] is not None and _master_data['version'] == version:
+            age = time.time() - _master_data['fetched_at']
+            if age >= app.config['MASTER_DATA_TTL'] and not _master_data['refreshing']:
+                _master_data['refreshing'] = True
+                threading.Thread(
+                    target=_refresh_master_data_in_background, args=(version,),
+                    name='master-data-refresh', daemon=True
+                ).start()
+            return _master_data['values']
+
+    values = fetch_master_data()
+    store_master_data(values, version)
+    return values
+
+
+def invalidate_master_data():
+    """マスタデータのキャッシュを全プロセス分無効にする（次回アクセス時に取り直す）"""
+    db = get_db()
+    with db:
+        bump_cache_version(db, 'master_data')
+    with _master_data_lock:
+        _master_data['values'] = None
+    try:
+        os.remove(app.config['MASTER_DATA_CACHE_FILE'])
+    except FileNotFoundError:
+        pass
+    return get_cache_version(db, 'master_data')
+
+
+def get_dropdown_values(sheet_name):
+    """マスタシートの1列目（ヘッダーを除く）をプルダウンの選択肢として取得する"""
+    return get_master_data()[sheet_name]
 
 #プルダウン形式での出庫情報入力
 def get_shukkosaki_options():
-    sheet = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(
-        json.load(open(os.environ['GOOGLE_CREDENTIALS_JSON'])),
-        ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    )).open('【開発用】シードル出庫台帳').worksheet('出庫先')
-    return sheet.col_values(1)[1:]  # ヘッダーを除く
+    return get_dropdown_values('出庫先')
 
 def get_product_options():
-    sheet = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(
-        json.load(open(os.environ['GOOGLE_CREDENTIALS_JSON'])),
-        ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    )).open('【開発用】シードル出庫台帳').worksheet('商品名')
-    return sheet.col_values(1)[1:]
+    return get_dropdown_values('商品名')
 
 def get_staff_options():
-    sheet = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(
-        json.load(open(os.environ['GOOGLE_CREDENTIALS_JSON'])),
-        ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    )).open('【開発用】シードル出庫台帳').worksheet('スタッフ')
-    return sheet.col_values(1)[1:]
+    return get_dropdown_values('スタッフ')
 
 
 # 新しい出庫IDを生成
-def generate_unique_id(出庫情報シート):
+def generate_unique_id():
     """日付ベースのユニークな出庫IDを生成する (例: 240521-001)"""
-    today_str = datetime.now().strftime("%y%m%d")
-    all_values = 出庫情報シート.get_all_values()
-    # ヘッダー行を除き、今日の日付で始まるIDをフィルタリング
-    all_ids = [row[0] for row in all_values[1:] if row and row[0].startswith(today_str)]
-    counter = len(all_ids) + 1
-    return f"{today_str}-{str(counter).zfill(3)}"
+    return allocate_shukko_ids(datetime.now().strftime("%y%m%d"))[0]
+
+
+def allocate_shukko_ids(day, count=1):
+    """指定日（yymmdd）の出庫IDを count 件まとめて払い出す
+
+    日付ごとのカウンタをSQLite上で原子的に進めるため、複数のワーカーから同時に
+    呼ばれても同じIDは払い出されない。その日のカウンタがまだ無い場合だけ、
+    出庫シートのミラーから当日の最大番号を求めて初期値にする（シートに障害があっても
+    前回取得したミラーがあれば登録できる）。
+    """
+    if count <= 0:
+        return []
+    db = get_db()
+    if db.execute('SELECT 1 FROM shukko_id_counter WHERE day = ?', (day,)).fetchone() is None:
+        seed = max_shukko_number_in_mirror(day)
+        with db:
+            db.execute(
+                'INSERT OR IGNORE INTO shukko_id_counter (day, last_number) VALUES (?, ?)',
+                (day, seed)
+            )
+    with db:
+        last_number = db.execute(
+            'UPDATE shukko_id_counter SET last_number = last_number + ? WHERE day = ? RETURNING last_number',
+            (count, day)
+        ).fetchone()['last_number']
+    return [f'{day}-{n:03d}' for n in range(last_number - count + 1, last_number + 1)]
+
+
+def max_shukko_number_in_mirror(day):
+    """出庫情報のミラー（反映待ちの行を含む）から、指定日（yymmdd）の出庫IDの最大連番を取得する"""
+    ensure_sheet_mirror()
+    db = get_db()
+    existing_ids = [
+        row['shukko_id'] for row in db.execute(
+            'SELECT shukko_id FROM shukko_info_mirror WHERE shukko_id LIKE ?', (f'{day}-%',)
+        )
+    ]
+    pattern = re.compile(rf'^{day}-(\d+)$')
+    numbers = [int(m.group(1)) for m in map(pattern.match, existing_ids) if m]
+    return max(numbers, default=0)
 
 # SQLiteデータベースへの接続
 def get_db():
-    """SQLiteデータベースへの接続を取得する"""
-    db = sqlite3.connect(app.config['DATABASE'])
+    """SQLiteデータベースへの接続を取得する（アプリケーションコンテキストごとに1つを使い回す）"""
+    if 'db' not in g:
+        g.db = connect_db()
+    return g.db
+
+
+def connect_db():
+    """設定に従ってプラグマを適用した新しい接続を作る"""
+    synchronous = app.config['SQLITE_SYNCHRONOUS'].upper()
+    if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f'SQLITE_SYNCHRONOUS の値が不正です: {synchronous}')
+    db = sqlite3.connect(
+        app.config['DATABASE'],
+        timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        # SQL文は定数として書いているので、準備済みステートメントはこのキャッシュで使い回される
+        cached_statements=app.config['SQLITE_STATEMENT_CACHE_SIZE'],
+        factory=InstrumentedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection
+    )
     db.row_factory = sqlite3.Row
+    db.execute(f'PRAGMA synchronous = {synchronous}')
+    db.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    db.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    db.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
     return db
 
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
 # SQLiteデータベースの初期化
 def init_db():
     """データベーステーブルを初期化（存在しない場合のみ作成）"""
     with app.app_context():
         db = get_db()
+        # WALモードにすると、読み込み（/data など）と取り込み中の書き込みが互いを待たない
+        db.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
         with db:
             db.execute('''
                 CREATE TABLE IF NOT EXISTS alcohol_sales (
@@ -103,22 +690,1263 @@ def init_db():
                     uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-        db.close()
+            # 出庫情報・出庫詳細シートのローカルミラー（row_number はシート上の行番号）
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS shukko_info_mirror (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    shukko_id TEXT NOT NULL,
+                    row_number INTEGER,
+                    shukko_date TEXT NOT NULL DEFAULT '',
+                    destination TEXT NOT NULL DEFAULT '',
+                    client TEXT NOT NULL DEFAULT '',
+                    staff TEXT NOT NULL DEFAULT ''
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_shukko_info_mirror_id ON shukko_info_mirror (shukko_id)')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS shukko_detail_mirror (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    shukko_id TEXT NOT NULL,
+                    row_number INTEGER,
+                    product_name TEXT NOT NULL DEFAULT '',
+                    quantity TEXT NOT NULL DEFAULT ''
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_shukko_detail_mirror_id ON shukko_detail_mirror (shukko_id)')
+            # 日付（yymmdd）ごとの出庫ID払い出しカウンタ
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS shukko_id_counter (
+                    day TEXT PRIMARY KEY,
+                    last_number INTEGER NOT NULL
+                )
+            ''')
+            # スプレッドシートへの反映ジョブ（status: pending / running / done / failed）
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS sync_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    result TEXT,
+                    run_after REAL NOT NULL,
+                    locked_until REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_sync_jobs_status ON sync_jobs (status, run_after)')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS sheet_mirror_state (
+                    name TEXT PRIMARY KEY,
+                    refreshed_at REAL NOT NULL
+                )
+            ''')
+        apply_migrations(db)
+
+
+# スキーマの変更履歴（適用済みの番号は PRAGMA user_version に記録する）
+# 既存のデータベースにも順に適用されるよう、変更は必ず末尾に追加すること
+SCHEMA_MIGRATIONS = [
+    # 1: alcohol_sales の一覧・絞り込み・ファイル単位の削除用インデックス
+    [
+        'CREATE INDEX IF NOT EXISTS idx_alcohol_sales_date_id ON alcohol_sales (date, id)',
+        'CREATE INDEX IF NOT EXISTS idx_alcohol_sales_source_filename ON alcohol_sales (source_filename)',
+        'CREATE INDEX IF NOT EXISTS idx_alcohol_sales_product_name ON alcohol_sales (product_name)',
+    ],
+    # 2: 日別・月別×商品の集計テーブル（alcohol_sales への登録・削除と同じトランザクションでトリガーが更新する）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS sales_daily_summary (
+            date TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            total_count INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            PRIMARY KEY (date, product_name)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_monthly_summary (
+            month TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            total_count INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            PRIMARY KEY (month, product_name)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_alcohol_sales_summary_insert AFTER INSERT ON alcohol_sales
+        BEGIN
+            INSERT INTO sales_daily_summary (date, product_name, total_count, row_count)
+            VALUES (NEW.date, NEW.product_name, NEW.sales_count, 1)
+            ON CONFLICT (date, product_name) DO UPDATE
+            SET total_count = total_count + excluded.total_count, row_count = row_count + 1;
+            INSERT INTO sales_monthly_summary (month, product_name, total_count, row_count)
+            VALUES (substr(NEW.date, 1, 7), NEW.product_name, NEW.sales_count, 1)
+            ON CONFLICT (month, product_name) DO UPDATE
+            SET total_count = total_count + excluded.total_count, row_count = row_count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_alcohol_sales_summary_delete AFTER DELETE ON alcohol_sales
+        BEGIN
+            UPDATE sales_daily_summary
+            SET total_count = total_count - OLD.sales_count, row_count = row_count - 1
+            WHERE date = OLD.date AND product_name = OLD.product_name;
+            DELETE FROM sales_daily_summary
+            WHERE date = OLD.date AND product_name = OLD.product_name AND row_count <= 0;
+            UPDATE sales_monthly_summary
+            SET total_count = total_count - OLD.sales_count, row_count = row_count - 1
+            WHERE month = substr(OLD.date, 1, 7) AND product_name = OLD.product_name;
+            DELETE FROM sales_monthly_summary
+            WHERE month = substr(OLD.date, 1, 7) AND product_name = OLD.product_name AND row_count <= 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_alcohol_sales_summary_update
+        AFTER UPDATE OF date, product_name, sales_count ON alcohol_sales
+        BEGIN
+            UPDATE sales_daily_summary
+            SET total_count = total_count - OLD.sales_count, row_count = row_count - 1
+            WHERE date = OLD.date AND product_name = OLD.product_name;
+            DELETE FROM sales_daily_summary
+            WHERE date = OLD.date AND product_name = OLD.product_name AND row_count <= 0;
+            UPDATE sales_monthly_summary
+            SET total_count = total_count - OLD.sales_count, row_count = row_count - 1
+            WHERE month = substr(OLD.date, 1, 7) AND product_name = OLD.product_name;
+            DELETE FROM sales_monthly_summary
+            WHERE month = substr(OLD.date, 1, 7) AND product_name = OLD.product_name AND row_count <= 0;
+            INSERT INTO sales_daily_summary (date, product_name, total_count, row_count)
+            VALUES (NEW.date, NEW.product_name, NEW.sales_count, 1)
+            ON CONFLICT (date, product_name) DO UPDATE
+            SET total_count = total_count + excluded.total_count, row_count = row_count + 1;
+            INSERT INTO sales_monthly_summary (month, product_name, total_count, row_count)
+            VALUES (substr(NEW.date, 1, 7), NEW.product_name, NEW.sales_count, 1)
+            ON CONFLICT (month, product_name) DO UPDATE
+            SET total_count = total_count + excluded.total_count, row_count = row_count + 1;
+        END
+        ''',
+        # 既存データから集計テーブルを作り直す
+        'DELETE FROM sales_daily_summary',
+        'DELETE FROM sales_monthly_summary',
+        '''
+        INSERT INTO sales_daily_summary (date, product_name, total_count, row_count)
+        SELECT date, product_name, SUM(sales_count), COUNT(*) FROM alcohol_sales GROUP BY date, product_name
+        ''',
+        '''
+        INSERT INTO sales_monthly_summary (month, product_name, total_count, row_count)
+        SELECT substr(date, 1, 7), product_name, SUM(sales_count), COUNT(*) FROM alcohol_sales
+        GROUP BY substr(date, 1, 7), product_name
+        ''',
+    ],
+    # 3: 商品名の対応表と、対応表になかったPOS商品名の一覧
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS product_name_mapping (
+            label_key TEXT PRIMARY KEY,
+            pos_label TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS unmapped_product_labels (
+            label_key TEXT PRIMARY KEY,
+            pos_label TEXT NOT NULL,
+            last_filename TEXT,
+            seen_count INTEGER NOT NULL DEFAULT 0,
+            last_seen_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        ''',
+        lambda db: seed_product_mapping(db),
+    ],
+    # 4: 出庫情報一覧の並べ替え・絞り込み（キーセットページング）用インデックス
+    [
+        'CREATE INDEX IF NOT EXISTS idx_shukko_info_mirror_date ON shukko_info_mirror (shukko_date, shukko_id)',
+        'CREATE INDEX IF NOT EXISTS idx_shukko_info_mirror_destination '
+        'ON shukko_info_mirror (destination, shukko_date, shukko_id)',
+        'CREATE INDEX IF NOT EXISTS idx_shukko_info_mirror_staff ON shukko_info_mirror (staff, shukko_date, shukko_id)',
+    ],
+    # 5: alcohol_sales を (販売日, 商品名, ファイル名) で一意にする（再取り込みは UPSERT で上書き）
+    # 既存の重複行は最も古い行に販売数を合計してから削除する（集計テーブルはトリガーが合わせる）
+    [
+        '''
+        UPDATE alcohol_sales SET sales_count = (
+            SELECT SUM(s.sales_count) FROM alcohol_sales AS s
+            WHERE s.date = alcohol_sales.date AND s.product_name = alcohol_sales.product_name
+              AND s.source_filename = alcohol_sales.source_filename
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM alcohol_sales GROUP BY date, product_name, source_filename HAVING COUNT(*) > 1
+        )
+        ''',
+        '''
+        DELETE FROM alcohol_sales WHERE id NOT IN (
+            SELECT MIN(id) FROM alcohol_sales GROUP BY date, product_name, source_filename
+        )
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_alcohol_sales_key ON alcohol_sales (date, product_name, source_filename)',
+    ],
+    # 6: 反映前・反映中に削除された出庫のジョブを取り消す印
+    [
+        lambda db: add_column_if_missing(db, 'sync_jobs', 'cancelled', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    # 7: 売上データの反映ジョブが払い出した出庫ID（突き合わせで削除してよいのはこの出庫だけ）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS sales_ledger_entries (
+            shukko_id TEXT PRIMARY KEY,
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 8: 出庫シートへの書き込みをプロセス間で1つずつにするためのロック（sheet_write_lock）
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS sheet_locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            locked_until REAL NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 9: ジョブを取り出したワーカーの印（期限切れで他のワーカーが取り直した後の古い更新を無視する）
+    [
+        lambda db: add_column_if_missing(db, 'sync_jobs', 'claim_token', 'TEXT'),
+    ],
+]
+
+
+def add_column_if_missing(db, table, column, definition):
+    """列がなければ追加する（ALTER TABLE ADD COLUMN には IF NOT EXISTS がないため）"""
+    columns = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def apply_migrations(db):
+    """未適用のスキーマ変更を順に適用する"""
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    for number, statements in enumerate(SCHEMA_MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        with db:
+            for statement in statements:
+                # SQLで書けない変更（初期データの投入など）は関数で渡す
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.execute(statement)
+            db.execute(f'PRAGMA user_version = {number}')
+        logger.info("スキーマ変更 %d を適用しました", number)
 
 # 許可されたファイル拡張子かチェック
-def allowed_file(filename):
+def allowed_file(filename, extensions=None):
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+           filename.rsplit('.', 1)[1].lower() in (extensions or app.config['ALLOWED_EXTENSIONS'])
 
-# ファイルのハッシュ値を計算（重複チェック用）
-def calculate_file_hash(filepath):
-    hasher = hashlib.md5()
-    with open(filepath, 'rb') as f:
-        hasher.update(f.read())
-    return hasher.hexdigest()
+# アップロードされたファイルは内容のハッシュ値をファイル名にして保存する（同じ内容なら一度しか書き込まない）
+def stored_upload_path(file_hash):
+    if not re.fullmatch(r'[0-9a-f]{32}', file_hash or ''):
+        raise ValueError('ファイルハッシュの形式が不正です')
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'{file_hash}.csv')
+
+
+def store_upload(stream):
+    """ストリームの内容を保存し、(ハッシュ値, 保存先のパス) を返す
+
+    ファイル全体をメモリに読み込まず、一時ファイルに書き込みながらハッシュ値を計算し（読み込みは1回）、
+    最後にハッシュ値のパスへ置き換える。同じ内容が既に保存済みなら一時ファイルは削除する。
+    書き込み途中のファイルを他のリクエストが読むことはない。
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+                hasher.update(chunk)
+                f.write(chunk)
+        file_hash = hasher.hexdigest()
+        filepath = stored_upload_path(file_hash)
+        if os.path.exists(filepath):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, filepath)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return file_hash, filepath
+
+# POSの商品名（CSVのA列）から出庫台帳の商品名への対応表の初期データ
+# （実際の対応表は product_name_mapping テーブルにあり、/mappings から編集する）
+PRODUCT_NAME_MAPPING = {
+    "シードル辛口フル　2180円": "シードル辛口2025／フル",
+    "シードル甘口ハーフ　1250円": "シードル甘口2025／ハーフ",
+    "シードル辛口ハーフ　1250円": "シードル辛口2025／ハーフ",
+    "シードル　低アルコール　2180円": "低アルコール2025／フル",
+    "シードル甘口フル　2180円": "シードル甘口2025／フル",
+    "洋梨スパークリング　フル　2600円": "洋梨／フル2025",
+    "洋梨スパークリング　ハーフ　1500円": "洋梨／ハーフ2025",
+    "ワインハーフボトル1500円": "ワイン／ハーフ2025",
+    "ワインフルボトル2600円": "ワイン／フル2025",
+    "シナノブレンド甘口　1250円": "シナノブレンド甘口2025",
+    "シナノブレンド辛口　1250円": "シナノブレンド辛口2025",
+    "シードル【フル】3本セット　6500円": "シードル3本セット2025／フル"
+}
+
+
+# --- 商品名の正規化と対応表 ---
+# POSの商品名は全角・半角や空白の入れ方、末尾の価格（「2180円」など）が変わることがあるため、
+# NFKC正規化 → 空白の除去 → 末尾の価格表記の除去 をしたものを照合キーにする。
+
+PRICE_SUFFIX_PATTERN = r'(?:¥[\d,]+|[\d,]+円)$'
+WHITESPACE_PATTERN = r'\s+'
+
+_product_mapping_cache = {'version': None, 'mapping': {}}
+_product_mapping_lock = threading.Lock()
+
+
+def normalize_product_label(label):
+    """POS商品名1件を照合キーに正規化する"""
+    key = unicodedata.normalize('NFKC', str(label))
+    key = re.sub(WHITESPACE_PATTERN, '', key)
+    return re.sub(PRICE_SUFFIX_PATTERN, '', key)
+
+
+def normalize_product_labels(labels):
+    """POS商品名の Series をまとめて照合キーに正規化する（normalize_product_label のベクトル版）"""
+    return (
+        labels.str.normalize('NFKC')
+        .str.replace(WHITESPACE_PATTERN, '', regex=True)
+        .str.replace(PRICE_SUFFIX_PATTERN, '', regex=True)
+    )
+
+
+def get_product_mapping():
+    """商品名の対応表 {照合キー: 台帳の商品名} を返す
+
+    プロセス内にキャッシュし、DB上のバージョン番号が変わった（他のプロセスで編集された）ときだけ読み直す。
+    """
+    db = get_db()
+    version = get_cache_version(db, 'product_name_mapping')
+    with _product_mapping_lock:
+        if _product_mapping_cache['version'] != version:
+            _product_mapping_cache['mapping'] = {
+                r['label_key']: r['product_name']
+                for r in db.execute('SELECT label_key, product_name FROM product_name_mapping')
+            }
+            _product_mapping_cache['version'] = version
+        return _product_mapping_cache['mapping']
+
+
+def get_cache_version(db, name):
+    row = db.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+    return row['version'] if row else 0
+
+
+def bump_cache_version(db, name):
+    """キャッシュのバージョン番号を進め、各プロセスのキャッシュを無効にする"""
+    db.execute(
+        'INSERT INTO cache_versions (name, version) VALUES (?, 1) '
+        'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+        (name,)
+    )
+
+
+def save_product_mapping(pos_label, product_name):
+    """対応表に商品名を登録（同じ照合キーがあれば上書き）し、未登録一覧から取り除く"""
+    label_key = normalize_product_label(pos_label)
+    db = get_db()
+    with db:
+        db.execute(
+            'INSERT INTO product_name_mapping (label_key, pos_label, product_name) VALUES (?, ?, ?) '
+            'ON CONFLICT (label_key) DO UPDATE SET pos_label = excluded.pos_label, '
+            'product_name = excluded.product_name, updated_at = CURRENT_TIMESTAMP',
+            (label_key, pos_label, product_name)
+        )
+        db.execute('DELETE FROM unmapped_product_labels WHERE label_key = ?', (label_key,))
+        bump_cache_version(db, 'product_name_mapping')
+
+
+def delete_product_mapping(label_key):
+    db = get_db()
+    with db:
+        db.execute('DELETE FROM product_name_mapping WHERE label_key = ?', (label_key,))
+        bump_cache_version(db, 'product_name_mapping')
+
+
+def record_unmapped_labels(unmapped, filename):
+    """対応表になかったPOS商品名を未登録一覧に記録する（呼び出し元のトランザクション内で実行）"""
+    if not unmapped:
+        return
+    logger.warning("対応表にない商品名がありました（%s）: %s", filename, dict(unmapped))
+    get_db().executemany(
+        'INSERT INTO unmapped_product_labels (label_key, pos_label, last_filename, seen_count, last_seen_at) '
+        'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP) '
+        'ON CONFLICT (label_key) DO UPDATE SET pos_label = excluded.pos_label, '
+        'last_filename = excluded.last_filename, seen_count = seen_count + excluded.seen_count, '
+        'last_seen_at = excluded.last_seen_at',
+        [(normalize_product_label(label), label, filename, int(count)) for label, count in unmapped.items()]
+    )
+
+
+def seed_product_mapping(db):
+    """スキーマ変更用：対応表の初期データを登録する"""
+    db.executemany(
+        'INSERT OR IGNORE INTO product_name_mapping (label_key, pos_label, product_name) VALUES (?, ?, ?)',
+        [(normalize_product_label(label), label, name) for label, name in PRODUCT_NAME_MAPPING.items()]
+    )
+
+
+# --- 出庫情報・出庫詳細シートのローカルミラー ---
+# 一覧・詳細・編集ページはシート全体をダウンロードせず、SQLite上のミラーを出庫IDで引く。
+# ミラーは SHEETS_MIRROR_TTL 秒ごとに取り直し、アプリ自身の書き込みはその場で反映する。
+
+_mirror_refresh_lock = threading.Lock()
+_sheet_write_lock_state = threading.local()
+
+
+@contextlib.contextmanager
+def sheet_write_lock():
+    """出庫シートの行番号が変わる書き込み（追記・行の挿入・削除）とミラーへの反映を、プロセスをまたいで1つずつ行う
+
+    行の確認から書き込み、ミラーの行番号の更新までをこのロックの中で行えば、他のワーカーの
+    追記や削除で行がずれることはない。SQLite の sheet_locks の行を期限つきで取り合うので、
+    保持したままプロセスが落ちても SHEETS_WRITE_LOCK_SECONDS 秒後には他が取得できる。
+    同じスレッド内では入れ子にできる（内側では何もしない）。
+    """
+    owner = getattr(_sheet_write_lock_state, 'owner', None)
+    if owner is not None:
+        yield
+        return
+
+    owner = f'{os.getpid()}-{threading.get_ident()}-{random.getrandbits(32):08x}'
+    deadline = time.monotonic() + app.config['SHEETS_WRITE_LOCK_TIMEOUT']
+    while not _try_sheet_write_lock(owner):
+        if time.monotonic() >= deadline:
+            raise RuntimeError('スプレッドシートへの他の書き込みが終わらないため、処理を中止しました')
+        time.sleep(0.1 + random.random() * 0.2)
+    _sheet_write_lock_state.owner = owner
+    try:
+        yield
+    finally:
+        _sheet_write_lock_state.owner = None
+        db = get_db()
+        with db:
+            db.execute('DELETE FROM sheet_locks WHERE name = ? AND owner = ?', ('shukko', owner))
+
+
+def _try_sheet_write_lock(owner):
+    """ロックが空いているか期限切れなら取得する"""
+    now = time.time()
+    db = get_db()
+    with db:
+        return db.execute(
+            '''
+            INSERT INTO sheet_locks (name, owner, locked_until) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, locked_until = excluded.locked_until
+            WHERE sheet_locks.locked_until < ?
+            ''',
+            ('shukko', owner, now + app.config['SHEETS_WRITE_LOCK_SECONDS'], now)
+        ).rowcount == 1
+
+
+def extend_sheet_write_lock():
+    """保持中のロックの期限を延ばす（大量の行を追記するジョブがチャンクごとに呼ぶ）"""
+    owner = getattr(_sheet_write_lock_state, 'owner', None)
+    if owner is None:
+        return
+    db = get_db()
+    with db:
+        db.execute(
+            'UPDATE sheet_locks SET locked_until = ? WHERE name = ? AND owner = ?',
+            (time.time() + app.config['SHEETS_WRITE_LOCK_SECONDS'], 'shukko', owner)
+        )
+
+
+def _pad_row(row, length):
+    return (list(row) + [''] * length)[:length]
+
+
+def refresh_sheet_mirror(force=False):
+    """ミラーが古ければ（または force=True なら）両シートを一度の API 呼び出しで取り直す
+
+    他のワーカーの書き込みの途中の状態を読んでミラーの行番号がずれないよう、書き込みのロックの中で取り直す。
+    """
+    if not force and not sheet_mirror_is_stale():
+        return False
+    with sheet_write_lock(), _mirror_refresh_lock:
+        if not force and not sheet_mirror_is_stale():
+            return False
+
+        spreadsheet = get_spreadsheet()
+        response = call_with_backoff(spreadsheet.values_batch_get, ["'出庫情報'", "'出庫詳細'"])
+        value_ranges = response.get('valueRanges', [])
+        info_values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+        detail_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+
+        # 1行目はヘッダーなので除外する（行番号はシート上の番号に合わせて2始まり）
+        info_rows = [
+            [row_number] + _pad_row(row, 5)
+            for row_number, row in enumerate(info_values[1:], start=2)
+            if row and row[0]
+        ]
+        detail_rows = [
+            [row_number] + _pad_row(row, 3)
+            for row_number, row in enumerate(detail_values[1:], start=2)
+            if row and row[0]
+        ]
+
+        db = get_db()
+        with db:
+            # 反映待ち（row_number が NULL）の行は残す
+            db.execute('DELETE FROM shukko_info_mirror WHERE row_number IS NOT NULL')
+            db.execute('DELETE FROM shukko_detail_mirror WHERE row_number IS NOT NULL')
+            db.executemany(
+                'INSERT INTO shukko_info_mirror (row_number, shukko_id, shukko_date, destination, client, staff) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                info_rows
+            )
+            db.executemany(
+                'INSERT INTO shukko_detail_mirror (row_number, shukko_id, product_name, quantity) VALUES (?, ?, ?, ?)',
+                detail_rows
+            )
+            # 取得したシートに既に載っている反映待ちの行は、シート側の行を正とする
+            for table in ('shukko_info_mirror', 'shukko_detail_mirror'):
+                db.execute(
+                    f'DELETE FROM {table} WHERE row_number IS NULL AND shukko_id IN '
+                    f'(SELECT shukko_id FROM {table} WHERE row_number IS NOT NULL)'
+                )
+            db.execute(
+                'INSERT OR REPLACE INTO sheet_mirror_state (name, refreshed_at) VALUES (?, ?)',
+                ('shukko', time.time())
+            )
+        logger.info("出庫シートのミラーを更新しました（出庫情報 %d 行 / 出庫詳細 %d 行）", len(info_rows), len(detail_rows))
+        return True
+
+
+def sheet_mirror_is_stale():
+    """ミラーの最終更新から SHEETS_MIRROR_TTL 秒以上経過しているか"""
+    db = get_db()
+    state = db.execute('SELECT refreshed_at FROM sheet_mirror_state WHERE name = ?', ('shukko',)).fetchone()
+    return state is None or time.time() - state['refreshed_at'] >= app.config['SHEETS_MIRROR_TTL']
+
+
+def mark_sheet_mirror_stale():
+    """次回の参照時にミラーを取り直させる（行番号が追跡できない変更の後に呼ぶ）"""
+    db = get_db()
+    with db:
+        db.execute('DELETE FROM sheet_mirror_state WHERE name = ?', ('shukko',))
+
+
+def ensure_sheet_mirror():
+    """参照前にミラーを最新化する（取得に失敗しても既存のミラーがあればそれを使う）"""
+    try:
+        refresh_sheet_mirror()
+    except Exception as e:
+        db = get_db()
+        has_mirror = db.execute('SELECT 1 FROM sheet_mirror_state WHERE name = ?', ('shukko',)).fetchone()
+        if not has_mirror:
+            raise
+        logger.error("出庫シートのミラー更新に失敗したため、前回のデータを表示します: %s", e)
+
+
+# 出庫情報一覧で並べ替えに使える列（同じ値の行は出庫IDで並べる）
+SHUKKO_SORT_COLUMNS = {
+    'date': 'shukko_date',
+    'id': 'shukko_id',
+    'destination': 'destination',
+    'staff': 'staff',
+}
+
+
+def shukko_where_clause(filters):
+    """出庫情報一覧の絞り込み条件から WHERE 句とパラメータを組み立てる"""
+    conditions, params = [], []
+    if filters.get('date_from'):
+        conditions.append('shukko_date >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        conditions.append('shukko_date <= ?')
+        params.append(filters['date_to'])
+    if filters.get('destination'):
+        conditions.append('destination = ?')
+        params.append(filters['destination'])
+    if filters.get('staff'):
+        conditions.append('staff = ?')
+        params.append(filters['staff'])
+    return conditions, params
+
+
+def mirror_list_shukko(filters, sort='date', order='desc', after_value=None, after_id=None, limit=None):
+    """ミラーから出庫情報を並べ替え・絞り込みしてキーセットページングで取得する
+
+    前ページ最後の行の (並べ替え列の値, 出庫ID) を渡すと、その続きから limit 件を返す。
+    戻り値は (行のリスト, 次ページの開始位置 or None)。
+    """
+    ensure_sheet_mirror()
+    limit = min(max(limit or app.config['LIST_PAGE_SIZE'], 1), app.config['LIST_PAGE_SIZE_MAX'])
+    column = SHUKKO_SORT_COLUMNS.get(sort, 'shukko_date')
+    direction = 'ASC' if order == 'asc' else 'DESC'
+    comparison = '>' if order == 'asc' else '<'
+
+    conditions, params = shukko_where_clause(filters)
+    if after_id is not None:
+        if column == 'shukko_id':
+            conditions.append(f'shukko_id {comparison} ?')
+            params.append(after_id)
+        elif after_value is not None:
+            conditions.append(f'({column}, shukko_id) {comparison} (?, ?)')
+            params.extend([after_value, after_id])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order_by = f'shukko_id {direction}' if column == 'shukko_id' else f'{column} {direction}, shukko_id {direction}'
+
+    db = get_db()
+    rows = db.execute(
+        f'SELECT shukko_id, shukko_date, destination, client, staff, row_number FROM shukko_info_mirror {where} '
+        f'ORDER BY {order_by} LIMIT ?',
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = {'after_value': rows[-1][column], 'after_id': rows[-1]['shukko_id']}
+    return rows, next_cursor
+
+
+def mirror_distinct_values(column):
+    """ミラーの出庫情報から列の値の一覧を取得する（一覧の絞り込み用）"""
+    ensure_sheet_mirror()
+    return [
+        row[0] for row in get_db().execute(
+            f"SELECT DISTINCT {column} FROM shukko_info_mirror WHERE {column} != '' ORDER BY {column}"
+        )
+    ]
+
+
+def mirror_find_shukko(shukko_id):
+    """ミラーから出庫IDに一致する出庫情報（と行番号）を取得する"""
+    ensure_sheet_mirror()
+    db = get_db()
+    row = db.execute(
+        'SELECT shukko_id, shukko_date, destination, client, staff, row_number FROM shukko_info_mirror '
+        'WHERE shukko_id = ? ORDER BY row_number LIMIT 1',
+        (shukko_id,)
+    ).fetchone()
+    return row
+
+
+def mirror_find_details(shukko_id):
+    """ミラーから出庫IDに一致する出庫詳細（と行番号）を取得する"""
+    ensure_sheet_mirror()
+    db = get_db()
+    rows = db.execute(
+        'SELECT shukko_id, product_name, quantity, row_number FROM shukko_detail_mirror '
+        'WHERE shukko_id = ? ORDER BY row_number',
+        (shukko_id,)
+    ).fetchall()
+    return rows
+
+
+def mirror_append_rows(info_rows=(), info_row_numbers=(), detail_rows=(), detail_row_numbers=()):
+    """シートへ追記した行をミラーにも反映する（行番号が分からなければミラーを古い扱いにする）"""
+    if None in info_row_numbers or None in detail_row_numbers:
+        mark_sheet_mirror_stale()
+        return
+    db = get_db()
+    with db:
+        insert_mirror_rows(db, info_rows, info_row_numbers, detail_rows, detail_row_numbers)
+
+
+def insert_mirror_rows(db, info_rows, info_row_numbers, detail_rows, detail_row_numbers):
+    """ミラーに行を登録する（トランザクションは呼び出し側で管理する）"""
+    db.executemany(
+        'INSERT INTO shukko_info_mirror (row_number, shukko_id, shukko_date, destination, client, staff) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        [[n] + _pad_row([str(v) for v in row], 5) for n, row in zip(info_row_numbers, info_rows)]
+    )
+    db.executemany(
+        'INSERT INTO shukko_detail_mirror (row_number, shukko_id, product_name, quantity) VALUES (?, ?, ?, ?)',
+        [[n] + _pad_row([str(v) for v in row], 3) for n, row in zip(detail_row_numbers, detail_rows)]
+    )
+
+
+def coalesce_row_ranges(row_numbers):
+    """行番号を連続した範囲 [(開始行, 終了行), ...] にまとめる（両端を含む・降順）"""
+    ranges = []
+    for n in sorted(set(row_numbers)):
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return [tuple(r) for r in reversed(ranges)]
+
+
+def sheet_rows_match(expected):
+    """{シート名: {行番号: 出庫ID}} の各行のA列が期待どおりか、一度の API 呼び出しで確認する"""
+    ranges = []
+    for sheet_name, ids_by_row in expected.items():
+        for start, end in coalesce_row_ranges(ids_by_row):
+            ranges.append((sheet_name, start, end))
+    if not ranges:
+        return True
+
+    response = call_with_backoff(
+        get_spreadsheet().values_batch_get,
+        [f"'{sheet_name}'!A{start}:A{end}" for sheet_name, start, end in ranges]
+    )
+    for (sheet_name, start, end), value_range in zip(ranges, response.get('valueRanges', [])):
+        values = value_range.get('values', [])
+        for offset, row_number in enumerate(range(start, end + 1)):
+            actual = values[offset][0] if offset < len(values) and values[offset] else ''
+            if actual != expected[sheet_name][row_number]:
+                return False
+    return True
+
+
+def delete_sheet_rows(expected):
+    """{シート名: {行番号: 出庫ID}} の行を、連続範囲ごとの deleteDimension にまとめて一度の batch_update で削除する
+
+    削除前にA列の出庫IDを確認し、ミラーとシートがずれていれば削除せず False を返す。
+    """
+    expected = {name: rows for name, rows in expected.items() if rows}
+    if not expected:
+        return True
+    with sheet_write_lock():
+        return _delete_sheet_rows(expected)
+
+
+def _delete_sheet_rows(expected):
+    if not sheet_rows_match(expected):
+        return False
+
+    requests = []
+    for sheet_name, ids_by_row in expected.items():
+        sheet_id = get_worksheet(sheet_name).id
+        # 同じシート内は下の範囲から削除すれば、上の範囲の行番号はずれない
+        for start, end in coalesce_row_ranges(ids_by_row):
+            requests.append({
+                'deleteDimension': {
+                    'range': {
+                        'sheetId': sheet_id,
+                        'dimension': 'ROWS',
+                        'startIndex': start - 1,
+                        'endIndex': end,
+                    }
+                }
+            })
+    try:
+        # deleteDimension は2回実行すると別の行まで消えるので、5xx では再試行しない
+        call_with_backoff(get_spreadsheet().batch_update, {'requests': requests}, retry_server_errors=False)
+    except Exception:
+        # 削除されたかどうか分からないので、行番号は次回の参照時に取り直す
+        mark_sheet_mirror_stale()
+        raise
+    mirror_delete_rows(expected)
+    return True
+
+
+def delete_shukko_records(shukko_ids):
+    """出庫ID群の出庫情報・出庫詳細の行をまとめて削除し、削除した出庫情報の件数を返す"""
+    shukko_ids = list(dict.fromkeys(shukko_ids))
+    if not shukko_ids:
+        return 0
+    ensure_sheet_mirror()
+    # シートへの反映待ちの出庫はミラーから消してジョブを取り消す（ジョブ側で書き込みを取りやめる）
+    pending_count = cancel_pending_shukko(shukko_ids)
+    # ミラーが古くて行番号がずれていた場合は、取り直して一度だけやり直す
+    for _ in range(2):
+        expected = mirror_rows_for_ids(shukko_ids)
+        if delete_sheet_rows(expected):
+            return len(expected['出庫情報']) + pending_count
+        refresh_sheet_mirror(force=True)
+    raise RuntimeError('スプレッドシートの行がローカルのミラーと一致しないため削除を中止しました')
+
+
+def detail_lines_token(lines):
+    """出庫詳細の [(商品名, 数量), ...] から楽観的排他制御用のトークンを作る"""
+    payload = json.dumps([[str(name), str(quantity)] for name, quantity in lines], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def read_detail_lines(shukko_id, row_numbers):
+    """シート上の指定行（A〜C列）を一度の API 呼び出しで読み、[(商品名, 数量), ...] を返す
+
+    いずれかの行のA列が shukko_id でなければ（行がずれていれば）None を返す。
+    """
+    ranges = coalesce_row_ranges(row_numbers)
+    if not ranges:
+        return []
+    response = call_with_backoff(
+        get_spreadsheet().values_batch_get, [f"'出庫詳細'!A{start}:C{end}" for start, end in ranges]
+    )
+    values_by_row = {}
+    for (start, end), value_range in zip(ranges, response.get('valueRanges', [])):
+        values = value_range.get('values', [])
+        for offset, row_number in enumerate(range(start, end + 1)):
+            values_by_row[row_number] = _pad_row(values[offset] if offset < len(values) else [], 3)
+    lines = []
+    for row_number in row_numbers:
+        row = values_by_row.get(row_number)
+        if row is None or row[0] != shukko_id:
+            return None
+        lines.append((row[1], row[2]))
+    return lines
+
+
+def _cell_value(value):
+    """updateCells 用のセルの値（数値として読めるものは数値で書き込む）"""
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        return {'userEnteredValue': {'stringValue': text}}
+    return {'userEnteredValue': {'numberValue': int(number) if number.is_integer() else number}}
+
+
+def apply_detail_edit(shukko_id, current, new_lines):
+    """出庫詳細の現在の行と新しい内容の差分だけを、一度の batch_update でシートに反映する
+
+    current は [(行番号, 商品名, 数量), ...]（シート上の並び順）、new_lines は [(商品名, 数量), ...]。
+    先頭から順に対応づけ、変わった行はセルを更新し、増えた行は最後の行の下に挿入し、
+    減った行は削除する。変更が無ければ API は呼ばない。
+    current を読んだときから sheet_write_lock を保持したまま呼ぶこと。
+    """
+    sheet_id = get_worksheet('出庫詳細').id
+    requests = []
+    updated = []
+    for (row_number, name, quantity), (new_name, new_quantity) in zip(current, new_lines):
+        if (str(name), str(quantity)) == (str(new_name), str(new_quantity)):
+            continue
+        requests.append({
+            'updateCells': {
+                'start': {'sheetId': sheet_id, 'rowIndex': row_number - 1, 'columnIndex': 1},
+                'rows': [{'values': [_cell_value(new_name), _cell_value(new_quantity)]}],
+                'fields': 'userEnteredValue',
+            }
+        })
+        updated.append((row_number, new_name, new_quantity))
+
+    inserted = [[shukko_id, name, quantity] for name, quantity in new_lines[len(current):]]
+    insert_after = current[-1][0] if current else None
+    if inserted and insert_after is not None:
+        requests.append({
+            'insertDimension': {
+                'range': {
+                    'sheetId': sheet_id,
+                    'dimension': 'ROWS',
+                    'startIndex': insert_after,
+                    'endIndex': insert_after + len(inserted),
+                },
+                'inheritFromBefore': True,
+            }
+        })
+        requests.append({
+            'updateCells': {
+                'start': {'sheetId': sheet_id, 'rowIndex': insert_after, 'columnIndex': 0},
+                'rows': [{'values': [_cell_value(v) for v in row]} for row in inserted],
+                'fields': 'userEnteredValue',
+            }
+        })
+    elif inserted:
+        # 既存の行が無い場合は末尾に追記する（行番号が分からないのでミラーは取り直す）
+        requests.append({
+            'appendCells': {
+                'sheetId': sheet_id,
+                'rows': [{'values': [_cell_value(v) for v in row]} for row in inserted],
+                'fields': 'userEnteredValue',
+            }
+        })
+
+    deleted = {row_number: shukko_id for row_number, _, _ in current[len(new_lines):]}
+    # 同じシート内は下の範囲から削除すれば、上の範囲の行番号はずれない
+    for start, end in coalesce_row_ranges(deleted):
+        requests.append({
+            'deleteDimension': {
+                'range': {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start - 1, 'endIndex': end}
+            }
+        })
+
+    if not requests:
+        return False
+    structural = inserted or deleted
+    try:
+        # 行の挿入・削除を含む場合は2回実行すると結果が変わるので、5xx では再試行しない
+        call_with_backoff(get_spreadsheet().batch_update, {'requests': requests}, retry_server_errors=not structural)
+    except Exception:
+        if structural:
+            mark_sheet_mirror_stale()
+        raise
+
+    mirror_update_details(updated)
+    if inserted and insert_after is not None:
+        mirror_insert_detail_rows(insert_after, inserted)
+    elif inserted:
+        mark_sheet_mirror_stale()
+    if deleted:
+        mirror_delete_rows({'出庫詳細': deleted})
+    return True
+
+
+def mirror_rows_for_ids(shukko_ids):
+    """ミラーから出庫ID群に該当する {シート名: {行番号: 出庫ID}} を取得する"""
+    placeholders = ','.join('?' * len(shukko_ids))
+    db = get_db()
+    info_rows = db.execute(
+        f'SELECT row_number, shukko_id FROM shukko_info_mirror '
+        f'WHERE shukko_id IN ({placeholders}) AND row_number IS NOT NULL',
+        shukko_ids
+    ).fetchall()
+    detail_rows = db.execute(
+        f'SELECT row_number, shukko_id FROM shukko_detail_mirror '
+        f'WHERE shukko_id IN ({placeholders}) AND row_number IS NOT NULL',
+        shukko_ids
+    ).fetchall()
+    return {
+        '出庫情報': {r['row_number']: r['shukko_id'] for r in info_rows},
+        '出庫詳細': {r['row_number']: r['shukko_id'] for r in detail_rows},
+    }
+
+
+def mirror_delete_rows(deleted):
+    """シートから削除した行をミラーからも削除し、下の行の行番号を詰める"""
+    tables = {'出庫情報': 'shukko_info_mirror', '出庫詳細': 'shukko_detail_mirror'}
+    db = get_db()
+    with db:
+        for sheet_name, ids_by_row in deleted.items():
+            table = tables[sheet_name]
+            for start, end in coalesce_row_ranges(ids_by_row):
+                db.execute(f'DELETE FROM {table} WHERE row_number BETWEEN ? AND ?', (start, end))
+                db.execute(
+                    f'UPDATE {table} SET row_number = row_number - ? WHERE row_number > ?',
+                    (end - start + 1, end)
+                )
+
+
+def mirror_add_pending(db, info_rows, detail_rows):
+    """シートへの反映待ちの出庫をミラーに登録する（行番号はジョブ完了時に設定・呼び出し側のトランザクションで使う）"""
+    insert_mirror_rows(db, info_rows, [None] * len(info_rows), detail_rows, [None] * len(detail_rows))
+
+
+def mirror_assign_row_numbers(job_id, shukko_id, info_row_numbers, detail_row_numbers):
+    """反映待ちだった出庫に、シートへ追記された行番号を設定する
+
+    ジョブが取り消されていれば何もせず False を返す。ジョブの行を先に更新して書き込みロックを取るので、
+    cancel_pending_shukko とはどちらか一方が先に確定する。
+    """
+    db = get_db()
+    with db:
+        active = db.execute(
+            'UPDATE sync_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ? AND cancelled = 0', (job_id,)
+        ).rowcount
+        if not active:
+            return False
+        if None in info_row_numbers or None in detail_row_numbers:
+            db.execute('DELETE FROM sheet_mirror_state WHERE name = ?', ('shukko',))
+            return True
+        for row_number in info_row_numbers:
+            db.execute(
+                'UPDATE shukko_info_mirror SET row_number = ? WHERE id = '
+                '(SELECT id FROM shukko_info_mirror WHERE shukko_id = ? AND row_number IS NULL ORDER BY id LIMIT 1)',
+                (row_number, shukko_id)
+            )
+        for row_number in detail_row_numbers:
+            db.execute(
+                'UPDATE shukko_detail_mirror SET row_number = ? WHERE id = '
+                '(SELECT id FROM shukko_detail_mirror WHERE shukko_id = ? AND row_number IS NULL ORDER BY id LIMIT 1)',
+                (row_number, shukko_id)
+            )
+    return True
+
+
+def cancel_pending_shukko(shukko_ids):
+    """シートへの反映待ちの出庫をミラーから削除し、その登録ジョブを同じトランザクションで取り消す
+
+    削除した出庫情報の件数を返す。実行中のジョブは取り消しの印を見て書き込みをやめ、
+    書き込み済みの行があれば削除する（sync_register_job）。
+    """
+    placeholders = ','.join('?' * len(shukko_ids))
+    db = get_db()
+    with db:
+        deleted = db.execute(
+            f'DELETE FROM shukko_info_mirror WHERE shukko_id IN ({placeholders}) AND row_number IS NULL',
+            shukko_ids
+        ).rowcount
+        db.execute(
+            f'DELETE FROM shukko_detail_mirror WHERE shukko_id IN ({placeholders}) AND row_number IS NULL',
+            shukko_ids
+        )
+        db.execute(
+            f"UPDATE sync_jobs SET cancelled = 1, updated_at = CURRENT_TIMESTAMP "
+            f"WHERE kind = 'register' AND status IN ('pending', 'running') "
+            f"AND json_extract(payload, '$.shukko_id') IN ({placeholders})",
+            shukko_ids
+        )
+    return deleted
+
+
+def mirror_update_info(shukko_id, 出庫日, 出庫先, 取引先, 担当者):
+    """出庫情報の更新をミラーにも反映する"""
+    db = get_db()
+    with db:
+        db.execute(
+            'UPDATE shukko_info_mirror SET shukko_date = ?, destination = ?, client = ?, staff = ? WHERE shukko_id = ?',
+            (出庫日, 出庫先, 取引先, 担当者, shukko_id)
+        )
+
+
+def mirror_update_details(updated):
+    """シートで書き換えた出庫詳細の行 [(行番号, 商品名, 数量), ...] をミラーにも反映する"""
+    db = get_db()
+    with db:
+        db.executemany(
+            'UPDATE shukko_detail_mirror SET product_name = ?, quantity = ? WHERE row_number = ?',
+            [(str(name), str(quantity), row_number) for row_number, name, quantity in updated]
+        )
+
+
+def mirror_insert_detail_rows(after_row, rows):
+    """シートの after_row 行目の下に挿入した出庫詳細の行をミラーにも反映する"""
+    db = get_db()
+    with db:
+        db.execute(
+            'UPDATE shukko_detail_mirror SET row_number = row_number + ? WHERE row_number > ?',
+            (len(rows), after_row)
+        )
+        db.executemany(
+            'INSERT INTO shukko_detail_mirror (row_number, shukko_id, product_name, quantity) VALUES (?, ?, ?, ?)',
+            [(after_row + offset, *map(str, row)) for offset, row in enumerate(rows, start=1)]
+        )
+
+
+# --- スプレッドシート反映ジョブのキュー ---
+# 遅くクォータ制限のあるSheetsへの書き込みはSQLite上のキューに積み、
+# 各プロセスのバックグラウンドスレッドが再試行（指数バックオフ）しながら処理する。
+
+_sync_worker = {'thread': None, 'pid': None}
+_sync_worker_wakeup = threading.Event()
+_sync_worker_lock = threading.Lock()
+
+
+def enqueue_sync_job(kind, payload):
+    """ジョブを積んでIDを返す（呼び出し元がトランザクション中なら、その中で積む）"""
+    db = get_db()
+    in_transaction = db.in_transaction
+    job_id = db.execute(
+        'INSERT INTO sync_jobs (kind, payload, run_after) VALUES (?, ?, ?)',
+        (kind, json.dumps(payload, ensure_ascii=False), time.time())
+    ).lastrowid
+    if not in_transaction:
+        db.commit()
+    start_sync_worker()
+    _sync_worker_wakeup.set()
+    return job_id
+
+
+class SyncJobLost(Exception):
+    """処理中のジョブの期限が切れ、他のワーカーに取り直された"""
 
-# データベースを初期化
-init_db()
+
+def save_job_payload(job, payload):
+    """処理途中の進捗（払い出したIDや書き込み済みの行番号）をジョブに記録し、処理中の期限を延ばす
+
+    他のワーカーに取り直されていれば記録せず SyncJobLost にする。
+    """
+    db = get_db()
+    with db:
+        saved = db.execute(
+            'UPDATE sync_jobs SET payload = ?, locked_until = ?, updated_at = CURRENT_TIMESTAMP '
+            'WHERE id = ? AND claim_token = ?',
+            (
+                json.dumps(payload, ensure_ascii=False), time.time() + app.config['SYNC_JOB_LEASE_SECONDS'],
+                job['id'], job['claim_token']
+            )
+        ).rowcount
+    if not saved:
+        raise SyncJobLost(f'ジョブ {job["id"]} は他のワーカーが処理しています')
+
+
+def append_job_rows(job, payload, key, worksheet, rows, value_input_option='RAW'):
+    """ジョブの行をチャンクごとに追記し、追記済みの行番号をチャンクごとに payload[key] に記録する
+
+    再試行時は記録済みの行の続きから追記するので、途中のチャンクで失敗しても同じ行は二重に追記されない。
+    各チャンクの追記の直前にジョブの期限を延ばす（他のワーカーに取り直されていれば追記しない）。
+    """
+    row_numbers = payload.setdefault(key, [])
+
+    def record(chunk_row_numbers):
+        row_numbers.extend(chunk_row_numbers)
+        save_job_payload(job, payload)
+        extend_sheet_write_lock()
+
+    if len(row_numbers) < len(rows):
+        save_job_payload(job, payload)
+        append_rows_in_chunks(worksheet, rows[len(row_numbers):], value_input_option, on_chunk=record)
+    return row_numbers
+
+
+def job_rows_resumed(payload):
+    """前回の試行で追記済みの行があるか
+
+    前回の試行から今回までの間は書き込みのロックを保持していないので、記録した行番号は
+    他のワーカーの削除でずれているかもしれない。その場合はミラーに使わず取り直させる。
+    """
+    return bool(payload.get('info_row_numbers') or payload.get('detail_row_numbers'))
+
+
+def sync_job_cancelled(job_id):
+    """ジョブが取り消されているか（cancel_pending_shukko で印が付く）"""
+    db = get_db()
+    return bool(db.execute('SELECT cancelled FROM sync_jobs WHERE id = ?', (job_id,)).fetchone()['cancelled'])
+
+
+def get_sync_job(job_id):
+    db = get_db()
+    job = db.execute(
+        'SELECT id, kind, status, attempts, last_error, result, created_at, updated_at FROM sync_jobs WHERE id = ?',
+        (job_id,)
+    ).fetchone()
+    return job
+
+
+def claim_sync_job():
+    """実行可能なジョブを1件取り出して running にする（他のプロセスと取り合っても1件は1か所でしか動かない）
+
+    取り出すたびに claim_token を付け直すので、期限切れで他のワーカーに取り直されたジョブの
+    古いワーカーからの更新（進捗の記録・完了・失敗）は反映されない。
+    """
+    now = time.time()
+    db = get_db()
+    with db:
+        job = db.execute(
+            '''
+            UPDATE sync_jobs
+            SET status = 'running', attempts = attempts + 1, locked_until = ?, claim_token = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM sync_jobs
+                WHERE (status = 'pending' AND run_after <= ?) OR (status = 'running' AND locked_until < ?)
+                ORDER BY id LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts, claim_token
+            ''',
+            (now + app.config['SYNC_JOB_LEASE_SECONDS'], os.urandom(8).hex(), now, now)
+        ).fetchone()
+    return job
+
+
+def requeue_sync_job(job_id):
+    """失敗したジョブを試行回数を数え直して実行待ちに戻す（失敗したジョブでなければ False）
+
+    記録済みの進捗（払い出したIDや追記済みの行番号）は残るので、続きから再開する。
+    """
+    db = get_db()
+    with db:
+        requeued = db.execute(
+            "UPDATE sync_jobs SET status = 'pending', attempts = 0, run_after = ?, claim_token = NULL, "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'failed'",
+            (time.time(), job_id)
+        ).rowcount
+    if requeued:
+        start_sync_worker()
+        _sync_worker_wakeup.set()
+    return bool(requeued)
+
+
+def run_sync_job(job):
+    """ジョブを1件実行し、結果に応じて done / pending（再試行）/ failed にする"""
+    handler = SYNC_JOB_HANDLERS[job['kind']]
+    try:
+        result = handler(job, json.loads(job['payload']))
+    except SyncJobLost as e:
+        logger.warning("ジョブ %s（%s）の処理を中断しました: %s", job['id'], job['kind'], e)
+        return
+    except Exception as e:
+        if job['attempts'] >= app.config['SYNC_JOB_MAX_ATTEMPTS']:
+            status, run_after = 'failed', time.time()
+        else:
+            status, run_after = 'pending', time.time() + min(2 ** job['attempts'], 300)
+        logger.error("ジョブ %s（%s）が失敗しました（%d 回目）: %s", job['id'], job['kind'], job['attempts'], e,
+                     exc_info=True)
+        db = get_db()
+        with db:
+            db.execute(
+                'UPDATE sync_jobs SET status = ?, run_after = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP '
+                'WHERE id = ? AND claim_token = ?',
+                (status, run_after, str(e), job['id'], job['claim_token'])
+            )
+        return
+
+    db = get_db()
+    with db:
+        finished = db.execute(
+            "UPDATE sync_jobs SET status = 'done', result = ?, last_error = NULL, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND claim_token = ?",
+            (json.dumps(result, ensure_ascii=False), job['id'], job['claim_token'])
+        ).rowcount
+    if not finished:
+        logger.warning("ジョブ %s（%s）は処理中に他のワーカーに取り直されていました", job['id'], job['kind'])
+
+
+def sync_worker_loop():
+    while True:
+        try:
+            with app.app_context():
+                job = claim_sync_job()
+                if job is not None:
+                    run_sync_job(job)
+                    continue
+        except Exception:
+            logger.exception("ジョブワーカーでエラーが発生しました")
+        _sync_worker_wakeup.wait(app.config['SYNC_JOB_POLL_INTERVAL'])
+        _sync_worker_wakeup.clear()
+
+
+def start_sync_worker():
+    """このプロセスのジョブワーカー（デーモンスレッド）を起動する（fork後の子プロセスでも1つだけ）"""
+    if not app.config['SYNC_WORKER_ENABLED']:
+        return
+    with _sync_worker_lock:
+        thread = _sync_worker['thread']
+        if thread is not None and thread.is_alive() and _sync_worker['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=sync_worker_loop, name='sheets-sync-worker', daemon=True)
+        thread.start()
+        _sync_worker['thread'] = thread
+        _sync_worker['pid'] = os.getpid()
+
+
+# データベースの初期化は import 時には行わない。
+# gunicorn では起動時にマスタープロセスで一度だけ（gunicorn.conf.py の on_starting）、
+# それ以外（flask run・テストなど）では最初のリクエストの前に ensure_db_schema() で行う。
+_db_schema = {'ready': False}
+_db_schema_lock = threading.Lock()
+
+
+def ensure_db_schema():
+    """このプロセスでまだならテーブル作成・スキーマ変更を行う（fork 前に済んでいれば何もしない）"""
+    if _db_schema['ready']:
+        return
+    with _db_schema_lock:
+        if not _db_schema['ready']:
+            init_db()
+            _db_schema['ready'] = True
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """テーブル作成・スキーマ変更を行う（flask --app app init-db）"""
+    ensure_db_schema()
 
 
 # --- 3. ルーティング（画面表示と処理） ---
@@ -135,10 +1963,8 @@ def register():
         担当者 = request.form['staff']
         取引先 = request.form.get('client', '')
 
-        出庫情報シート, 出庫詳細シート = connect_sheets()
-        出庫ID = generate_unique_id(出庫情報シート)
-
-        出庫情報シート.append_row([出庫ID, 出庫日, 出庫先, 取引先, 担当者])
+        出庫ID = generate_unique_id()
+        info_rows = [[出庫ID, 出庫日, 出庫先, 取引先, 担当者]]
 
         details_to_append = []
         for i in range(1, 6):
@@ -147,8 +1973,16 @@ def register():
             if 商品名 and 数量:
                 details_to_append.append([出庫ID, 商品名, 数量])
 
-        if details_to_append:
-            出庫詳細シート.append_rows(details_to_append, value_input_option='USER_ENTERED')
+        # ミラーには反映待ち（行番号なし）として先に登録し、シートへの追記はジョブキューで行う
+        # （ミラーの行とジョブは同じトランザクションで登録し、片方だけが残らないようにする）
+        db = get_db()
+        with db:
+            mirror_add_pending(db, info_rows, details_to_append)
+            enqueue_sync_job('register', {
+                'shukko_id': 出庫ID,
+                'info_rows': info_rows,
+                'detail_rows': details_to_append
+            })
 
         return render_template(
             'success.html',
@@ -157,16 +1991,9 @@ def register():
         )
 
     # GETリクエスト時：プルダウンの選択肢を取得してフォームに渡す
-    def get_dropdown_values(sheet_name):
-        sheet = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(
-            json.load(open(os.environ['GOOGLE_CREDENTIALS_JSON'])),
-            ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        )).open('【開発用】シードル出庫台帳').worksheet(sheet_name)
-        return sheet.col_values(1)[1:]  # ヘッダー行を除く
-
-    shukkosaki_options = get_dropdown_values('出庫先')
-    product_options = get_dropdown_values('商品名')
-    staff_options = get_dropdown_values('スタッフ')
+    shukkosaki_options = get_shukkosaki_options()
+    product_options = get_product_options()
+    staff_options = get_staff_options()
 
     return render_template(
         'register.html',
@@ -176,39 +2003,85 @@ def register():
     )
 
 
+def shukko_filters_from_request():
+    """リクエストのクエリ文字列から出庫情報一覧の絞り込み・並べ替え条件を取り出す"""
+    sort = request.args.get('sort', 'date')
+    return {
+        'date_from': request.args.get('date_from', ''),
+        'date_to': request.args.get('date_to', ''),
+        'destination': request.args.get('destination', ''),
+        'staff': request.args.get('staff', ''),
+        'sort': sort if sort in SHUKKO_SORT_COLUMNS else 'date',
+        'order': 'asc' if request.args.get('order') == 'asc' else 'desc',
+    }
+
+
+def shukko_page_from_request():
+    filters = shukko_filters_from_request()
+    rows, next_cursor = mirror_list_shukko(
+        filters,
+        sort=filters['sort'],
+        order=filters['order'],
+        after_value=request.args.get('after_value'),
+        after_id=request.args.get('after_id'),
+        limit=request.args.get('limit', type=int)
+    )
+    return filters, rows, next_cursor
+
+
 @app.route('/list')
 def list_data():
-    """出庫情報の一覧ページ"""
-    出庫情報シート, _ = connect_sheets()
-    出庫情報 = 出庫情報シート.get_all_values()
-    return render_template('list.html', 出庫情報=出庫情報)
+    """出庫情報の一覧ページ（続きのページはスクロールに合わせて /api/list から読み込む）"""
+    filters, 出庫情報, next_cursor = shukko_page_from_request()
+    # 続きのページも同じ件数で読み込む（limit が指定されていなければ既定の件数）
+    limit = request.args.get('limit', type=int)
+    next_url = url_for('list_data', **filters, **next_cursor, limit=limit) if next_cursor else None
+    next_api_url = url_for('list_data_json', **filters, **next_cursor, limit=limit) if next_cursor else None
+    return render_template(
+        'list.html',
+        出庫情報=出庫情報,
+        filters=filters,
+        destination_options=mirror_distinct_values('destination'),
+        staff_options=mirror_distinct_values('staff'),
+        next_url=next_url,
+        next_api_url=next_api_url
+    )
+
+
+@app.route('/api/list')
+def list_data_json():
+    """/list と同じ条件・ページングでの JSON 版"""
+    filters, 出庫情報, next_cursor = shukko_page_from_request()
+    limit = request.args.get('limit', type=int)
+    return jsonify({
+        'entries': [dict(row) for row in 出庫情報],
+        'next_cursor': next_cursor,
+        'next_url': url_for('list_data_json', **filters, **next_cursor, limit=limit) if next_cursor else None
+    })
+
+
+@app.route('/api/list/<shukko_id>/details')
+def list_details_json(shukko_id):
+    """一覧で行を開いたときに読み込む出庫詳細（JSON）"""
+    return jsonify({
+        'shukko_id': shukko_id,
+        'details': [dict(row) for row in mirror_find_details(shukko_id)]
+    })
 
 
 @app.route('/detail/<shukko_id>')
 def detail(shukko_id):
     """出庫情報の詳細ページ"""
-    出庫情報シート, 出庫詳細シート = connect_sheets()
-    出庫情報リスト = 出庫情報シート.get_all_values()
-    出庫情報 = next((row for row in 出庫情報リスト if row[0] == shukko_id), None)
-    出庫詳細リスト = 出庫詳細シート.get_all_values()
-    出庫詳細 = [row for row in 出庫詳細リスト if row[0] == shukko_id]
+    出庫情報 = mirror_find_shukko(shukko_id)
+    出庫詳細 = mirror_find_details(shukko_id)
     return render_template('detail.html', 出庫情報=出庫情報, 出庫詳細=出庫詳細, 出庫ID=shukko_id)
 
 
 @app.route('/edit/<shukko_id>', methods=['GET', 'POST'])
 def edit(shukko_id):
     """出庫情報の編集ページ"""
-    出庫情報シート, _ = connect_sheets()
-    出庫情報リスト = 出庫情報シート.get_all_values()
-    index = None
-    出庫情報 = None
-    for i, row in enumerate(出庫情報リスト):
-        if row[0] == shukko_id:
-            index = i + 1  # Sheetsは1始まり
-            出庫情報 = row
-            break
-    
-    if index is None:
+    出庫情報 = mirror_find_shukko(shukko_id)
+    if 出庫情報 is None:
         return "指定された出庫IDが見つかりません。", 404
 
     if request.method == 'POST':
@@ -216,7 +2089,21 @@ def edit(shukko_id):
         出庫先 = request.form['destination']
         取引先 = request.form['client']
         担当者 = request.form['staff']
-        出庫情報シート.update(f'B{index}:E{index}', [[出庫日, 出庫先, 取引先, 担当者]])
+        if 出庫情報['row_number'] is None:
+            return "スプレッドシートへの反映待ちです。しばらくしてから再度お試しください。", 409
+        出庫情報シート, _ = connect_sheets()
+        # ミラーの行番号がシートとずれていないか、A列の出庫IDで確認してから更新する
+        # （確認から更新までの間に他のワーカーが行を削除しないよう、書き込みのロックの中で行う）
+        with sheet_write_lock():
+            index = 出庫情報['row_number']
+            if not sheet_rows_match({'出庫情報': {index: shukko_id}}):
+                refresh_sheet_mirror(force=True)
+                出庫情報 = mirror_find_shukko(shukko_id)
+                if 出庫情報 is None or 出庫情報['row_number'] is None:
+                    return "指定された出庫IDが見つかりません。", 404
+                index = 出庫情報['row_number']
+            出庫情報シート.update(f'B{index}:E{index}', [[出庫日, 出庫先, 取引先, 担当者]])
+            mirror_update_info(shukko_id, 出庫日, 出庫先, 取引先, 担当者)
         return render_template(
             'success.html',
             message="出庫情報を更新しました",
@@ -227,66 +2114,67 @@ def edit(shukko_id):
 
 @app.route('/delete/<shukko_id>')
 def delete_shukko(shukko_id):
-    出庫情報シート, 出庫詳細シート = connect_sheets()
-
-    # 出庫情報シートから対象行を削除
-    cell = 出庫情報シート.find(shukko_id)
-    if cell:
-        出庫情報シート.delete_rows(cell.row)
+    # 出庫情報シート・出庫詳細シートの該当行を一度の batch_update で削除
+    delete_shukko_records([shukko_id])
+    return redirect(url_for('list_data'))  # 一覧に戻る
 
-    # 出庫詳細シートからも関連行を削除
-    cells = 出庫詳細シート.findall(shukko_id)
-    for c in reversed(cells):  # 後ろから削除しないとインデックスずれる
-        出庫詳細シート.delete_rows(c.row)
 
-    return redirect(url_for('list_data'))  # 一覧に戻る
+@app.route('/delete-bulk', methods=['POST'])
+def delete_shukko_bulk():
+    """一覧ページで選択した複数の出庫情報をまとめて削除する"""
+    shukko_ids = request.form.getlist('shukko_ids')
+    delete_shukko_records(shukko_ids)
+    return redirect(url_for('list_data'))
 
 
 
 @app.route('/edit-detail/<shukko_id>', methods=['GET', 'POST'])
 def edit_detail(shukko_id):
-    """出庫詳細の編集ページ"""
-    _, 出庫詳細シート = connect_sheets()
-    # 該当する出庫IDの行をすべて削除
-    # gspreadには特定の条件で行を削除する簡単なAPIがないため、一度クリアして再追加するアプローチが一般的
-    
-    # ここは元のコードのロジックが複雑でgspreadのAPI制限に引っかかりやすいため、
-    # より安全な「詳細ページに戻って、手動で修正してもらう」運用を推奨しますが、
-    # 元のロジックをベースに簡易的な更新処理を実装します。
+    """出庫詳細の編集ページ
 
+    フォームを開いたときの内容からトークンを作っておき、更新時にシートの現在の内容と照合する。
+    一致すれば差分（セルの更新・行の挿入・削除）だけを一度の batch_update で反映する。
+    """
     if request.method == 'POST':
-        # 既存の詳細を一旦クリア
-        all_details = 出庫詳細シート.get_all_records() # 辞書形式で取得
-        rows_to_delete = []
-        for i, record in enumerate(all_details):
-            if record.get('出庫ID') == shukko_id:
-                rows_to_delete.append(i + 2) # ヘッダーを考慮した行番号
-
-        # 後ろの行から削除しないとインデックスがずれる
-        for row_num in sorted(rows_to_delete, reverse=True):
-            出庫詳細シート.delete_rows(row_num)
-
-        # フォームから新しい詳細を追加
-        new_details = []
-        for i in range(1, 11): # 登録できる商品数を増やすなど調整可能
-             商品名 = request.form.get(f'item{i}')
-             数量 = request.form.get(f'qty{i}')
-             if 商品名 and 数量:
-                 new_details.append([shukko_id, 商品名, 数量])
-        
-        if new_details:
-            出庫詳細シート.append_rows(new_details, value_input_option='USER_ENTERED')
+        new_lines = []
+        for i in range(1, request.form.get('line_count', 10, type=int) + 1):
+            商品名 = request.form.get(f'item{i}', '').strip()
+            数量 = request.form.get(f'qty{i}', '').strip()
+            if 商品名 and 数量:
+                new_lines.append((商品名, 数量))
+
+        # 確認から反映までの間に他のワーカーが行をずらさないよう、書き込みのロックの中で行う
+        with sheet_write_lock():
+            出庫詳細 = mirror_find_details(shukko_id)
+            if any(row['row_number'] is None for row in 出庫詳細):
+                return "スプレッドシートへの反映待ちです。しばらくしてから再度お試しください。", 409
+
+            # フォームを開いた後にシートの行が変わっていないか確認する（楽観的排他制御）
+            row_numbers = [row['row_number'] for row in 出庫詳細]
+            sheet_lines = read_detail_lines(shukko_id, row_numbers)
+            if sheet_lines is None or detail_lines_token(sheet_lines) != request.form.get('token'):
+                refresh_sheet_mirror(force=True)
+                return "フォームを開いた後に出庫詳細が更新されています。画面を開き直してから再度編集してください。", 409
+
+            current = [
+                (row_number, name, quantity) for row_number, (name, quantity) in zip(row_numbers, sheet_lines)
+            ]
+            changed = apply_detail_edit(shukko_id, current, new_lines)
 
         return render_template(
             'success.html',
-            message="出庫詳細を更新しました",
+            message="出庫詳細を更新しました" if changed else "出庫詳細に変更はありませんでした",
             redirect_url=url_for('detail', shukko_id=shukko_id)
         )
-    
+
     # GETリクエストの場合、編集用のデータを渡す
-    出庫詳細リスト = 出庫詳細シート.get_all_values()
-    出庫詳細 = [row for row in 出庫詳細リスト if row[0] == shukko_id]
-    return render_template('edit_detail.html', 出庫ID=shukko_id, 出庫詳細=出庫詳細)
+    出庫詳細 = mirror_find_details(shukko_id)
+    token = detail_lines_token([(row['product_name'], row['quantity']) for row in 出庫詳細])
+    pending = any(row['row_number'] is None for row in 出庫詳細)
+    return render_template(
+        'edit_detail.html', 出庫ID=shukko_id, 出庫詳細=出庫詳細, token=token, pending=pending,
+        blank_lines=app.config['EDIT_DETAIL_BLANK_LINES']
+    )
 
 
 @app.route('/edit-detail/<shukko_id>/<detail_id>', methods=['POST'])
@@ -301,6 +2189,7 @@ def edit_shukko_detail(shukko_id, detail_id):
         row = cell.row
         出庫詳細シート.update_cell(row, 3, new_name)  # 商品名
         出庫詳細シート.update_cell(row, 4, new_qty)   # 数量
+        mark_sheet_mirror_stale()
 
     return redirect(url_for('detail', 出庫ID=shukko_id))
 
@@ -309,150 +2198,544 @@ def edit_shukko_detail(shukko_id, detail_id):
 def delete_detail(shukko_id, detail_id):
     出庫詳細シート = connect_sheets()[1]
 
-    cell = 出庫詳細シート.find(detail_id)
-    if cell:
-        出庫詳細シート.delete_rows(cell.row)
+    with sheet_write_lock():
+        cell = 出庫詳細シート.find(detail_id)
+        if cell:
+            出庫詳細シート.delete_rows(cell.row)
+            mark_sheet_mirror_stale()
 
     return redirect(url_for('detail', 出庫ID=shukko_id))
 
 
 
-def process_and_store_csv(filepath, filename, file_hash):
-    """CSVを解析し、「お酒類」のデータをDBとExcelに登録します。"""
-    try:
-        date_str = os.path.basename(filename).split('-')[0]
-        sale_date = datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
-        print(f"\n--- Processing file: {filename} for date: {sale_date} ---")
+# alcohol_sales テーブルに登録する列
+SALES_COLUMNS = ['date', 'product_name', 'sales_count', 'source_filename']
 
+
+def inspect_csv_head(filepath, sample_size=64 * 1024):
+    """ファイル先頭のバイト列だけを読み、文字コードと1行目の列数を判定する
+
+    UTF-8として解釈できなければ Shift_JIS（Windows拡張を含む cp932）とみなす。
+    先頭がすべてASCIIの場合は、最初に非ASCIIのバイトが現れる位置から判定する。
+    """
+    with open(filepath, 'rb') as f:
+        head = f.read(sample_size)
+        sample = head
+        while sample.isascii():
+            sample = f.read(sample_size)
+            if not sample:
+                break
+        if sample is not head:
+            # 直前までがすべてASCIIなので、最初の非ASCIIバイトは文字の先頭にあたる
+            sample = sample[next((i for i, byte in enumerate(sample) if byte >= 0x80), len(sample)):]
+
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
         try:
-            df = pd.read_csv(filepath, header=None, encoding='shift-jis')
-        except Exception:
-            df = pd.read_csv(filepath, header=None, encoding='utf-8')
-        
-        print(f"[DEBUG] CSV loaded. Shape: {df.shape}")
-        if 1 in df.columns:
-            unique_categories = df[1].astype(str).str.strip().unique()
-            print(f"[DEBUG] Unique categories in column B: {unique_categories}")
-        else:
-            return jsonify({'error': 'CSVファイルにカテゴリ列（B列）が見つかりません。'}), 500
-
-        df_filtered = df[df[1].astype(str).str.strip() == 'お酒類'].copy()
-        if df_filtered.empty:
-            return jsonify({'success': 'ファイルは処理されましたが、「お酒類」のデータは見つかりませんでした。'}), 200
-
-        if 0 not in df_filtered.columns or 7 not in df_filtered.columns:
-            return jsonify({'error': '必要な列（A列またはH列）が見つかりません。'}), 500
-
-        result_df = df_filtered[[0, 7]].copy()
-        result_df.columns = ['product_name', 'sales_count']
-        result_df['sales_count'] = pd.to_numeric(result_df['sales_count'], errors='coerce').fillna(0).astype(int)
-        result_df['date'] = sale_date
-        result_df['source_filename'] = filename
-
-        product_name_mapping = {
-            "シードル辛口フル　2180円": "シードル辛口2025／フル",
-            "シードル甘口ハーフ　1250円": "シードル甘口2025／ハーフ",
-            "シードル辛口ハーフ　1250円": "シードル辛口2025／ハーフ",
-            "シードル　低アルコール　2180円": "低アルコール2025／フル",
-            "シードル甘口フル　2180円": "シードル甘口2025／フル",
-            "洋梨スパークリング　フル　2600円": "洋梨／フル2025",
-            "洋梨スパークリング　ハーフ　1500円": "洋梨／ハーフ2025",
-            "ワインハーフボトル1500円": "ワイン／ハーフ2025",
-            "ワインフルボトル2600円": "ワイン／フル2025",
-            "シナノブレンド甘口　1250円": "シナノブレンド甘口2025",
-            "シナノブレンド辛口　1250円": "シナノブレンド辛口2025",
-            "シードル【フル】3本セット　6500円": "シードル3本セット2025／フル"
-        }
+            # サンプルの末尾で文字が途切れていてもエラーにしない
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'cp932'
+
+    first_line = head.decode(encoding, errors='ignore').splitlines()[:1]
+    n_columns = len(next(csv.reader(first_line), [])) if first_line else 0
+    return encoding, n_columns
+
+
+def iter_sales_chunks(filepath, filename, sale_date, encoding, mapping, chunksize=None):
+    """CSVをチャンク単位で読み込み、「お酒類」の行を登録用のデータフレームにして順に返す
+
+    読み込むのはA列（商品名）・B列（カテゴリ）・H列（販売数）だけなので、
+    ファイルが大きくてもメモリ使用量は CSV_CHUNK_SIZE 行分に収まる。
+    mapping は {正規化した商品名: 台帳の商品名}。対応のない行は product_name が欠損値になる。
+    """
+    import pandas as pd
+
+    reader = pd.read_csv(
+        filepath,
+        header=None,
+        encoding=encoding,
+        usecols=[0, 1, 7],
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunksize or app.config['CSV_CHUNK_SIZE']
+    )
+    with reader:
+        while True:
+            with timed('pandas_stage_duration_seconds', stage='read_csv'):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            with timed('pandas_stage_duration_seconds', stage='transform'):
+                chunk = chunk[chunk[1].str.strip() == 'お酒類']
+                if chunk.empty:
+                    continue
+                pos_labels = chunk[0].str.strip()
+                chunk_df = pd.DataFrame({
+                    'date': sale_date,
+                    'product_name': normalize_product_labels(pos_labels).map(mapping),
+                    'sales_count': pd.to_numeric(chunk[7], errors='coerce').fillna(0).astype(int),
+                    'source_filename': filename,
+                    'pos_label': pos_labels,
+                })
+            yield chunk_df
+
+
+def split_unmapped(chunk_df, unmapped):
+    """対応表にない商品の行を取り除き、そのPOS商品名と件数を unmapped（Counter）に加える"""
+    is_unmapped = chunk_df['product_name'].isna()
+    if is_unmapped.any():
+        unmapped.update(chunk_df.loc[is_unmapped, 'pos_label'].value_counts().to_dict())
+    return chunk_df.loc[~is_unmapped, SALES_COLUMNS]
+
+
+def add_sales_totals(totals, chunk_df):
+    """チャンクの行を (販売日, 商品名) ごとに合計して totals（辞書）に足し込む
+
+    同じファイルに同じ商品が複数行あっても、alcohol_sales には1行にまとめて登録する。
+    """
+    with timed('pandas_stage_duration_seconds', stage='aggregate'):
+        grouped = chunk_df.groupby(['date', 'product_name'], sort=False)['sales_count'].sum()
+        for key, count in grouped.items():
+            totals[key] = totals.get(key, 0) + int(count)
 
-        result_df['product_name'] = result_df['product_name'].astype(str).str.strip().map(product_name_mapping)
 
-        # マッピングされなかった商品は除外
-        result_df.dropna(subset=['product_name'], inplace=True)
+def sales_rows_from_totals(totals, filename):
+    """add_sales_totals で集計した結果を alcohol_sales の行（SALES_COLUMNS の順）にする"""
+    return [(date, product_name, count, filename) for (date, product_name), count in totals.items()]
 
-        print("[DEBUG] Data to be inserted (first 5 rows):")
-        print(result_df.head().to_string())
 
+def sale_date_from_filename(filename):
+    """ファイル名先頭の日付（例: 20240521-uriage.csv）から販売日（YYYY-MM-DD）を求める"""
+    date_str = os.path.basename(filename).split('-')[0]
+    return datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
+
+
+def csv_column_error(n_columns):
+    """CSVの列数が足りない場合のエラーメッセージを返す（問題なければ None）"""
+    if n_columns < 2:
+        return 'CSVファイルにカテゴリ列（B列）が見つかりません。'
+    if n_columns < 8:
+        return '必要な列（A列またはH列）が見つかりません。'
+    return None
+
+
+def parse_sales_file(filepath, filename, mapping, chunksize=None):
+    """CSVを解析して登録対象の行を返す（一括アップロードでプロセスプールから呼ばれる）
+
+    DBやスプレッドシートには触れず、結果は
+    {'filename', 'found_alcohol', 'rows', 'unmapped', 'error'} の辞書で返す。
+    """
+    result = {'filename': filename, 'found_alcohol': False, 'rows': [], 'unmapped': {}, 'error': None}
+    unmapped = Counter()
+    try:
+        sale_date = sale_date_from_filename(filename)
+        encoding, n_columns = inspect_csv_head(filepath)
+        result['error'] = csv_column_error(n_columns)
+        if result['error']:
+            return result
+        totals = {}
+        for chunk_df in iter_sales_chunks(filepath, filename, sale_date, encoding, mapping, chunksize):
+            result['found_alcohol'] = True
+            add_sales_totals(totals, split_unmapped(chunk_df, unmapped))
+        result['rows'] = sales_rows_from_totals(totals, filename)
+        result['unmapped'] = dict(unmapped)
+    except Exception as e:
+        result['error'] = f'CSV処理中に予期せぬエラーが発生しました: {e}'
+    return result
+
+
+# 同じ (販売日, 商品名, ファイル名) の行があれば販売数を上書きする（値が同じなら書き込まない）
+SALES_UPSERT_SQL = '''
+    INSERT INTO alcohol_sales (date, product_name, sales_count, source_filename) VALUES (?, ?, ?, ?)
+    ON CONFLICT (date, product_name, source_filename) DO UPDATE
+    SET sales_count = excluded.sales_count
+    WHERE sales_count != excluded.sales_count
+'''
+
+
+def store_sales_rows(db, filename, rows):
+    """1ファイル分の売上行を alcohol_sales に登録する（呼び出し側のトランザクションの中で使う）
+
+    rows は (販売日, 商品名) ごとに集計済みの行。準備済みの UPSERT を executemany で実行し、
+    前回の取り込みにあって今回のファイルにない行は削除するので、同じファイルを何度取り込んでも
+    結果は同じになる。戻り値は (件数の辞書, 新しく登録した行のリスト)。
+    """
+    existing = {
+        (row['date'], row['product_name']): row['sales_count']
+        for row in db.execute(
+            'SELECT date, product_name, sales_count FROM alcohol_sales WHERE source_filename = ?', (filename,)
+        )
+    }
+    inserted_rows = [row for row in rows if (row[0], row[1]) not in existing]
+    updated = sum(1 for row in rows if existing.get((row[0], row[1]), row[2]) != row[2])
+    loaded_keys = {(row[0], row[1]) for row in rows}
+    stale_keys = [key for key in existing if key not in loaded_keys]
+
+    db.executemany(SALES_UPSERT_SQL, rows)
+    if stale_keys:
+        db.executemany(
+            'DELETE FROM alcohol_sales WHERE date = ? AND product_name = ? AND source_filename = ?',
+            [(date, product_name, filename) for date, product_name in stale_keys]
+        )
+    counts = {
+        'inserted': len(inserted_rows),
+        'updated': updated,
+        'unchanged': len(rows) - len(inserted_rows) - updated,
+        'deleted': len(stale_keys),
+    }
+    logger.debug("alcohol_sales に登録しました: %s %s", filename, counts)
+    return counts, inserted_rows
+
+
+def sales_sheet_notice(counts, job_id):
+    """登録結果（store_sales_rows の件数）に応じて、スプレッドシートへの反映についての案内文を返す
+
+    ジョブで追記するのは新しく登録した行だけなので、販売数が変わった行・なくなった行は
+    出庫台帳とずれたままになる。その場合は突き合わせ（/reconcile）を案内する。
+    """
+    notices = []
+    if job_id is not None:
+        notices.append(f"新しく登録した {counts['inserted']} 件はスプレッドシートへバックグラウンドで追記します。")
+    changed = counts['updated'] + counts['deleted']
+    if changed:
+        notices.append(
+            f'前回の取り込みから販売数が変わった行・なくなった行（{changed} 件）はスプレッドシートに自動では反映されません。'
+            f"突き合わせ（{url_for('reconcile')}）で出庫台帳との差分を確認してください。"
+        )
+    if not notices:
+        notices.append('データベースの内容に変更はなかったため、スプレッドシートへの反映はありません。')
+    return ''.join(notices)
+
+
+def allocate_ids_for_sales(result_df):
+    """売上データの各行に、販売日ごとの出庫IDを払い出す"""
+    import pandas as pd
+
+    days = pd.to_datetime(result_df['date']).dt.strftime('%y%m%d')
+    shukko_ids = pd.Series(index=result_df.index, dtype=object)
+    for day, index in days.groupby(days).groups.items():
+        shukko_ids[index] = allocate_shukko_ids(day, len(index))
+    return shukko_ids.tolist()
+
+
+def process_and_store_csv(filepath, filename, file_hash):
+    """CSVを解析し、「お酒類」のデータをDBとスプレッドシートに登録します。"""
+    try:
+        sale_date = sale_date_from_filename(filename)
+        logger.info("CSVを処理します: %s（販売日 %s）", filename, sale_date)
+
+        encoding, n_columns = inspect_csv_head(filepath)
+        logger.debug("CSV encoding: %s, columns: %d", encoding, n_columns)
+        column_error = csv_column_error(n_columns)
+        if column_error:
+            return jsonify({'error': column_error}), 500
+
+        # チャンクごとにフィルタ・変換して (販売日, 商品名) ごとに合計する
+        found_alcohol = False
+        totals = {}
+        unmapped = Counter()
+        mapping = get_product_mapping()
+        for chunk_df in iter_sales_chunks(filepath, filename, sale_date, encoding, mapping):
+            found_alcohol = True
+            # マッピングされなかった商品は除外（商品名は未登録一覧に記録する）
+            add_sales_totals(totals, split_unmapped(chunk_df, unmapped))
+
+        # DBへの登録は1トランザクションで（再取り込みなら前回の行を上書き・削除する）
         conn = get_db()
         with conn:
-            result_df.to_sql('alcohol_sales', conn, if_exists='append', index=False)
-            conn.execute(
-                'INSERT OR IGNORE INTO upload_log (filename, file_hash) VALUES (?, ?)',
-                (filename, file_hash)
-            )
-        conn.close()
+            counts, inserted_rows = store_sales_rows(conn, filename, sales_rows_from_totals(totals, filename))
+            if found_alcohol:
+                conn.execute(
+                    'INSERT OR IGNORE INTO upload_log (filename, file_hash) VALUES (?, ?)',
+                    (filename, file_hash)
+                )
+            record_unmapped_labels(unmapped, filename)
+            # スプレッドシートへの反映はジョブキューに任せる（DB登録と同じトランザクションで積む）
+            # 追記するのは新しく登録した行だけ（再取り込みで同じ行が二重に追記されないように）
+            job_id = enqueue_sync_job('sales', {'rows': [list(row) for row in inserted_rows]}) if inserted_rows else None
+
+        notice = sales_sheet_notice(counts, job_id)
+        needs_reconcile = bool(counts['updated'] or counts['deleted'])
+        if not found_alcohol:
+            return jsonify({
+                'success': 'ファイルは処理されましたが、「お酒類」のデータは見つかりませんでした。'
+                           + (notice if needs_reconcile else ''),
+                'needs_reconcile': needs_reconcile,
+                **counts
+            }), 200
+
+        logger.info("CSVの処理が完了しました: %s %s", filename, counts)
+        return jsonify({
+            'success': 'ファイルが正常に処理され、データベースに登録されました。' + notice,
+            'job_id': job_id,
+            'unmapped_labels': dict(unmapped),
+            'needs_reconcile': needs_reconcile,
+            **counts
+        }), 200
 
-        # Google スプレッドシートへの追記
-        try:
+    except Exception as e:
+        logger.exception("CSV処理中にエラーが発生しました: %s", filename)
+        return jsonify({'error': f'CSV処理中に予期せぬエラーが発生しました: {e}'}), 500
+
+
+# 売上データから作る出庫の出庫先・担当者
+SALES_LEDGER_DESTINATION = '店頭販売'
+SALES_LEDGER_STAFF = '北沢'
+
+
+def build_sales_sheet_rows(result_df, shukko_ids):
+    """売上データから出庫情報シート・出庫詳細シートに追記する行を作る"""
+    # 出庫情報シート：出庫ID・日付・出庫先・取引先・担当者
+    info_rows = [
+        [shukko_id, date, SALES_LEDGER_DESTINATION, '', SALES_LEDGER_STAFF]
+        for shukko_id, date in zip(shukko_ids, result_df['date'])
+    ]
+    # 出庫詳細シート：出庫ID・商品名・数量
+    detail_rows = [
+        [shukko_id, product_name, int(sales_count)]
+        for shukko_id, product_name, sales_count
+        in zip(shukko_ids, result_df['product_name'], result_df['sales_count'])
+    ]
+    return info_rows, detail_rows
+
+
+def sync_sales_job(job, payload):
+    """売上データを出庫情報・出庫詳細シートへ一括で追記するジョブ
+
+    払い出した出庫IDと追記済みの行番号（チャンクごと）は payload に記録しておくので、
+    途中で失敗して再試行しても同じ行が二重に追記されることはない。
+    """
+    import pandas as pd
+
+    result_df = pd.DataFrame(payload['rows'], columns=SALES_COLUMNS)
+    if 'shukko_ids' not in payload:
+        payload['shukko_ids'] = allocate_ids_for_sales(result_df)
+        # 売上から作った出庫として記録しておく（手動登録の出庫と区別するため）
+        db = get_db()
+        with db:
+            db.executemany(
+                'INSERT OR IGNORE INTO sales_ledger_entries (shukko_id, job_id) VALUES (?, ?)',
+                [(shukko_id, job['id']) for shukko_id in payload['shukko_ids']]
+            )
+        save_job_payload(job, payload)
+    info_rows, detail_rows = build_sales_sheet_rows(result_df, payload['shukko_ids'])
+
+    sheet1, sheet2 = connect_sheets()
+    with sheet_write_lock():
+        resumed = job_rows_resumed(payload)
+        info_row_numbers = append_job_rows(job, payload, 'info_row_numbers', sheet1, info_rows)
+        detail_row_numbers = append_job_rows(job, payload, 'detail_row_numbers', sheet2, detail_rows)
+        if resumed:
+            mark_sheet_mirror_stale()
+        else:
+            mirror_append_rows(info_rows, info_row_numbers, detail_rows, detail_row_numbers)
+    logger.info("Googleスプレッドシートに売上データを追加しました（%d 件）", len(info_rows))
+    return {'出庫情報': len(info_rows), '出庫詳細': len(detail_rows)}
+
+
+def sync_register_job(job, payload):
+    """手動登録した出庫情報を出庫情報・出庫詳細シートへ追記するジョブ"""
+    job_id = job['id']
+    shukko_id = payload['shukko_id']
+    with sheet_write_lock():
+        # 反映待ちの間に削除された（ジョブが取り消された）出庫は書き込まない
+        if not sync_job_cancelled(job_id):
             sheet1, sheet2 = connect_sheets()
-            existing_ids = sheet1.col_values(1)[1:]  # 出庫ID列（ヘッダー除く）
-            today = datetime.strptime(sale_date, '%Y-%m-%d').strftime('%y%m%d')
-
-            # 使用済み番号セット
-            used_numbers = set()
-            for id_ in existing_ids:
-                match = re.match(rf'^{today}-(\d+)$', str(id_))
-                if match:
-                    used_numbers.add(int(match.group(1)))
-
-            # 出庫IDジェネレーター定義
-            def get_next_shukko_id(start=1):
-                num = start
-                while True:
-                    if num not in used_numbers:
-                        used_numbers.add(num)
-                        yield f'{today}-{num:03d}'
-                    num += 1
-
-            id_generator = get_next_shukko_id()
-            shukko_ids = []
-
-            for _, row in result_df.iterrows():
-                shukko_id = next(id_generator)
-                shukko_ids.append(shukko_id)
-
-            # Google Sheets に書き込む
-            write_to_google_sheets(result_df, shukko_ids)
-            print("[INFO] Googleスプレッドシートに出庫データを追加しました。")
+            resumed = job_rows_resumed(payload)
+            info_row_numbers = append_job_rows(job, payload, 'info_row_numbers', sheet1, payload['info_rows'])
+            # 手動登録の出庫詳細は従来どおり USER_ENTERED（数量を数値として入力する）
+            detail_row_numbers = append_job_rows(
+                job, payload, 'detail_row_numbers', sheet2, payload['detail_rows'], 'USER_ENTERED'
+            )
+            if resumed:
+                # 行番号が分からない扱いにすると、ミラーを古い扱いにして次回の参照時に取り直す
+                info_row_numbers = [None] * len(info_row_numbers)
+            if mirror_assign_row_numbers(job_id, shukko_id, info_row_numbers, detail_row_numbers):
+                return {'出庫情報': len(payload['info_rows']), '出庫詳細': len(payload['detail_rows'])}
 
-        except Exception as e:
-            print(f"[ERROR] Google Sheetsへの書き込みに失敗しました: {e}")
+        # 書き込みの途中で取り消された場合は、書き込み済みの行をシートから削除する
+        if payload.get('info_row_numbers') or payload.get('detail_row_numbers'):
+            refresh_sheet_mirror(force=True)
+            delete_shukko_records([shukko_id])
+            return {'skipped': '反映中に削除されたため、書き込んだ行を削除しました'}
+    return {'skipped': '反映前に削除されました'}
 
-        print("--- Processing finished successfully ---")
-        return jsonify({'success': 'ファイルが正常に処理され、データベースおよびスプレッドシートに登録されました。'}), 200
 
-    except Exception as e:
-        print(f"!!! An error occurred: {e} !!!")
-        traceback.print_exc()
-        return jsonify({'error': f'CSV処理中に予期せぬエラーが発生しました: {e}'}), 500
+# ジョブの種類ごとの処理
+SYNC_JOB_HANDLERS = {
+    'sales': sync_sales_job,
+    'register': sync_register_job,
+}
+
 
+# === 売上データと出庫台帳の突き合わせ ===
 
-def write_to_google_sheets(result_df, shukko_ids):
+RECONCILE_KEY_COLUMNS = ['date', 'product_name', 'quantity']
+
+
+def load_reconcile_sides(date_from='', date_to=''):
+    """突き合わせる両側（alcohol_sales と、売上から作った出庫の出庫詳細）を読み込む
+
+    シートは refresh_sheet_mirror で一度だけ取り直し（API 呼び出し1回）、あとはミラーから読む。
+    シート側は sales_ledger_entries に記録された出庫（from_sales=True）に加え、記録を始める前に
+    作られた分も照合できるよう、出庫先・担当者が売上データと同じ出庫も読み込む。
+    記録された出庫が先に照合されるよう、from_sales の行を先に並べる。
+    """
+    import pandas as pd
+
+    refresh_sheet_mirror(force=True)
+    db = get_db()
+    local_conditions, sheet_conditions, params = [], [], []
+    if date_from:
+        local_conditions.append('date >= ?')
+        sheet_conditions.append('i.shukko_date >= ?')
+        params.append(date_from)
+    if date_to:
+        local_conditions.append('date <= ?')
+        sheet_conditions.append('i.shukko_date <= ?')
+        params.append(date_to)
+
+    local_where = f"WHERE {' AND '.join(local_conditions)}" if local_conditions else ''
+    local = pd.DataFrame(
+        [tuple(row) for row in db.execute(
+            f'SELECT date, product_name, sales_count, source_filename FROM alcohol_sales {local_where}', params
+        )],
+        columns=['date', 'product_name', 'quantity', 'source_filename']
+    )
+    sheet = pd.DataFrame(
+        [tuple(row) for row in db.execute(
+            'SELECT i.shukko_date, d.product_name, d.quantity, d.shukko_id, d.row_number, i.row_number, '
+            's.shukko_id IS NOT NULL AS from_sales '
+            'FROM shukko_detail_mirror AS d JOIN shukko_info_mirror AS i ON i.shukko_id = d.shukko_id '
+            'LEFT JOIN sales_ledger_entries AS s ON s.shukko_id = d.shukko_id '
+            'WHERE (s.shukko_id IS NOT NULL OR (i.destination = ? AND i.staff = ?)) '
+            'AND d.row_number IS NOT NULL AND i.row_number IS NOT NULL'
+            + ''.join(f' AND {condition}' for condition in sheet_conditions)
+            + ' ORDER BY from_sales DESC, d.row_number',
+            [SALES_LEDGER_DESTINATION, SALES_LEDGER_STAFF] + params
+        )],
+        columns=['date', 'product_name', 'quantity', 'shukko_id', 'row_number', 'info_row_number', 'from_sales']
+    )
+    sheet['from_sales'] = sheet['from_sales'].astype(bool)
+    # シートの数量は文字列なので数値にそろえる（数値でなければどの売上とも一致しない）
+    sheet['quantity'] = pd.to_numeric(sheet['quantity'].str.strip(), errors='coerce').fillna(-1).astype(int)
+    local['quantity'] = local['quantity'].astype(int)
+    return local, sheet
+
+
+def diff_sales_ledger(local, sheet):
+    """(販売日, 商品名, 数量) のハッシュで両側を突き合わせ、(シートにない売上, 売上にないシートの行) を返す
+
+    同じキーの行が複数あっても数が合うかまで見るよう、キーごとの出現順の番号も合わせて比べる。
+    """
+    import pandas as pd
+
+    with timed('pandas_stage_duration_seconds', stage='reconcile'):
+        keyed = []
+        for frame in (local, sheet):
+            frame = frame.assign(key=pd.util.hash_pandas_object(frame[RECONCILE_KEY_COLUMNS], index=False).to_numpy())
+            keyed.append(frame.assign(occurrence=frame.groupby('key').cumcount()))
+        merged = keyed[0][['key', 'occurrence']].merge(
+            keyed[1][['key', 'occurrence']], on=['key', 'occurrence'], how='outer', indicator=True
+        )
+        missing_keys = merged.loc[merged['_merge'] == 'left_only', ['key', 'occurrence']]
+        extra_keys = merged.loc[merged['_merge'] == 'right_only', ['key', 'occurrence']]
+        missing = keyed[0].merge(missing_keys, on=['key', 'occurrence'])
+        extra = keyed[1].merge(extra_keys, on=['key', 'occurrence'])
+    return missing.drop(columns=['key', 'occurrence']), extra.drop(columns=['key', 'occurrence'])
+
+
+class ReconcileConflict(Exception):
+    """突き合わせの差分を今は適用できない（反映待ちのジョブがある・シートが変わった）"""
+
+
+def reconcile_sales_ledger(date_from='', date_to='', apply=False, delete_extra=False):
+    """alcohol_sales と出庫台帳を突き合わせ、差分（と適用結果）を辞書で返す
+
+    apply=True ならシートにない売上を 'sales' ジョブでまとめて追記し、delete_extra=True なら
+    売上にない出庫詳細の行（出庫詳細がすべて消える出庫は出庫情報の行も）を一度の batch_update で削除する。
+    削除の対象（extra_in_sheet）は売上データの反映ジョブが作った出庫だけで、手動登録など
+    それ以外の出庫で一致しなかった行は ignored_in_sheet の件数として返すだけにする。
+    反映待ちの売上ジョブがある間は差分が確定しないので適用しない。
+    """
+    # DBに取り込む前からある出庫まで消さないよう、削除は期間を指定したときだけ行う
+    if delete_extra and not (date_from and date_to):
+        raise ValueError('売上にない行を削除するときは、対象期間（開始日・終了日）を指定してください')
+    local, sheet = load_reconcile_sides(date_from, date_to)
+    missing, unmatched = diff_sales_ledger(local, sheet)
+    extra = unmatched[unmatched['from_sales']]
+    report = {
+        'date_from': date_from,
+        'date_to': date_to,
+        'local_rows': len(local),
+        'sheet_rows': len(sheet),
+        'matched': len(local) - len(missing),
+        'missing_in_sheet': missing[['date', 'product_name', 'quantity', 'source_filename']].to_dict('records'),
+        'extra_in_sheet': extra[['shukko_id', 'date', 'product_name', 'quantity', 'row_number']].to_dict('records'),
+        'ignored_in_sheet': len(unmatched) - len(extra),
+        'applied': None,
+    }
+    if not apply and not delete_extra:
+        return report
+
+    db = get_db()
+    pending = db.execute(
+        "SELECT COUNT(*) FROM sync_jobs WHERE kind = 'sales' AND status IN ('pending', 'running')"
+    ).fetchone()[0]
+    if pending:
+        raise ReconcileConflict(f'スプレッドシートへの反映待ちの売上ジョブが {pending} 件あるため、差分を適用できません')
+
+    applied = {'job_id': None, 'deleted': 0}
+    if apply and not missing.empty:
+        rows = missing.rename(columns={'quantity': 'sales_count'})[SALES_COLUMNS]
+        applied['job_id'] = enqueue_sync_job('sales', {'rows': rows.values.tolist()})
+    if delete_extra and not extra.empty:
+        # 出庫詳細の行がすべて削除対象になる出庫は、出庫情報の行も削除する
+        detail_counts = sheet.groupby('shukko_id').size()
+        extra_counts = extra.groupby('shukko_id').size()
+        emptied = extra_counts[extra_counts == detail_counts[extra_counts.index]].index
+        info_rows = extra.loc[extra['shukko_id'].isin(emptied)].drop_duplicates('shukko_id')
+        expected = {
+            '出庫情報': dict(zip(info_rows['info_row_number'].tolist(), info_rows['shukko_id'].tolist())),
+            '出庫詳細': dict(zip(extra['row_number'].tolist(), extra['shukko_id'].tolist())),
+        }
+        if not delete_sheet_rows(expected):
+            raise ReconcileConflict('スプレッドシートの行がローカルのミラーと一致しないため削除を中止しました')
+        applied['deleted'] = len(extra)
+    report['applied'] = applied
+    logger.info("売上データと出庫台帳の差分を適用しました: %s", applied)
+    return report
+
+
+@app.cli.command('reconcile')
+@click.option('--from', 'date_from', default='', help='対象期間の開始日（YYYY-MM-DD）')
+@click.option('--to', 'date_to', default='', help='対象期間の終了日（YYYY-MM-DD）')
+@click.option('--apply', 'apply', is_flag=True, help='シートにない売上を出庫台帳に追記する')
+@click.option('--delete-extra', is_flag=True, help='売上にない出庫台帳の行を削除する')
+def reconcile_command(date_from, date_to, apply, delete_extra):
+    """売上データと出庫台帳を突き合わせる（flask --app app reconcile --from 2024-05-01 --to 2024-05-31）"""
+    ensure_db_schema()
     try:
-        # シートに接続
-        sheet1, sheet2 = connect_sheets()
-
-        for i, (_, row) in enumerate(result_df.iterrows()):
-            shukko_id = shukko_ids[i]
-
-            # 出庫情報シート：出庫ID・日付・出庫先・取引先・担当者
-            sheet1.append_row([
-                shukko_id,
-                row['date'],
-                '店頭販売',
-                '',
-                '北沢'
-            ])
-
-            # 出庫詳細シート：出庫ID・商品名・数量
-            sheet2.append_row([
-                shukko_id,
-                row['product_name'],
-                row['sales_count']
-            ])
-
-        print("[INFO] Googleスプレッドシートにデータを追加しました。")
-    except Exception as e:
-        print(f"[ERROR] Googleスプレッドシートへの書き込みに失敗しました: {e}")
+        report = reconcile_sales_ledger(date_from, date_to, apply, delete_extra)
+    except (ReconcileConflict, ValueError) as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"売上 {report['local_rows']} 件 / 出庫台帳 {report['sheet_rows']} 件 / 一致 {report['matched']} 件"
+    )
+    click.echo(f"出庫台帳にない売上: {len(report['missing_in_sheet'])} 件")
+    for row in report['missing_in_sheet']:
+        click.echo(f"  + {row['date']} {row['product_name']} × {row['quantity']}（{row['source_filename']}）")
+    click.echo(f"売上にない出庫台帳の行: {len(report['extra_in_sheet'])} 件")
+    for row in report['extra_in_sheet']:
+        click.echo(f"  - {row['date']} {row['product_name']} × {row['quantity']}（{row['shukko_id']}・{row['row_number']}行目）")
+    if report['ignored_in_sheet']:
+        click.echo(f"売上データの反映で作られていないため対象外にした出庫台帳の行: {report['ignored_in_sheet']} 件")
+    if report['applied']:
+        click.echo(f"適用しました: 追記ジョブ {report['applied']['job_id']} / 削除 {report['applied']['deleted']} 行")
+
 
 
 
@@ -475,20 +2758,18 @@ def upload_file():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
 
         try:
-            file_hash = calculate_file_hash(filepath)
+            # 保存しながらハッシュを計算し、重複を確認する（上書き処理に備えて重複していても保存しておく）
+            file_hash, filepath = store_upload(file.stream)
             db = get_db()
-            cur = db.execute('SELECT * FROM upload_log WHERE file_hash = ?', (file_hash,))
+            cur = db.execute('SELECT 1 FROM upload_log WHERE file_hash = ?', (file_hash,))
             existing = cur.fetchone()
-            db.close()
 
             if existing:
                 return jsonify({
                     'status': 'confirm',
-                    'message': '同じ内容のファイルが既にアップロードされています。上書きして処理を続行しますか？ (既存のデータは削除されます)',
+                    'message': '同じ内容のファイルが既にアップロードされています。上書きして処理を続行しますか？ (既存のデータは上書きされます)',
                     'filename': filename,
                     'file_hash': file_hash
                 })
@@ -496,49 +2777,533 @@ def upload_file():
             return process_and_store_csv(filepath, filename, file_hash)
 
         except Exception as e:
-            print(f"!!! An error occurred during upload: {e} !!!")
-            traceback.print_exc()
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            logger.exception("アップロード処理中にエラーが発生しました: %s", filename)
             return jsonify({'error': f'ファイル処理中にエラーが発生しました: {e}'}), 500
     else:
         return jsonify({'error': '許可されていないファイル形式です'}), 400
 
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """複数のCSV（またはCSVをまとめたzip）の一括アップロード処理
+
+    CSVの解析はプロセスプールで並列に行い、重複チェックは1クエリ、DB登録は1トランザクションの UPSERT、
+    スプレッドシートへの追記は全ファイル分をまとめて1つのジョブで行う。
+    """
+    files = request.files.getlist('files')
+    if not files or all(f.filename == '' for f in files):
+        return jsonify({'error': 'ファイルが選択されていません'}), 400
+
+    report = []
+    entries = []  # (ファイル名, 内容を読み出すストリームを返す関数)
+    for file in files:
+        if not allowed_file(file.filename, app.config['BATCH_ALLOWED_EXTENSIONS']):
+            report.append({'filename': file.filename, 'status': 'error', 'message': '許可されていないファイル形式です'})
+            continue
+        filename = secure_filename(file.filename)
+        if filename.lower().endswith('.zip'):
+            try:
+                entries.extend(csv_entries_in_zip(file.stream))
+            except zipfile.BadZipFile:
+                report.append({'filename': filename, 'status': 'error', 'message': 'zipファイルを展開できません'})
+            except ValueError as e:
+                report.append({'filename': filename, 'status': 'error', 'message': str(e)})
+        else:
+            entries.append((filename, rewound(file.stream)))
+
+    # 同じファイル名が2つあると、後のファイルの登録で前のファイルの行が上書き・削除されるため後の方を除く
+    seen_filenames = set()
+    unique_entries = []
+    for filename, open_stream in entries:
+        if filename in seen_filenames:
+            report.append({
+                'filename': filename, 'status': 'error',
+                'message': '同じ名前のファイルがこの一括アップロードに含まれているため、処理しませんでした'
+            })
+            continue
+        seen_filenames.add(filename)
+        unique_entries.append((filename, open_stream))
+    entries = unique_entries
+
+    # 重複チェック（保存しながらハッシュを計算し、既存のアップロード履歴は1クエリで照合、同じバッチ内の重複も除く）
+    hashes = []
+    filepaths = []
+    for _, open_stream in entries:
+        with open_stream() as stream:
+            file_hash, filepath = store_upload(stream)
+        hashes.append(file_hash)
+        filepaths.append(filepath)
+    db = get_db()
+    placeholders = ','.join('?' * len(hashes))
+    known_hashes = {
+        row['file_hash'] for row in db.execute(
+            f'SELECT file_hash FROM upload_log WHERE file_hash IN ({placeholders})', hashes
+        )
+    } if hashes else set()
+
+    targets = []
+    for (filename, _), file_hash, filepath in zip(entries, hashes, filepaths):
+        if file_hash in known_hashes:
+            report.append({
+                'filename': filename, 'status': 'duplicate', 'file_hash': file_hash,
+                'message': '同じ内容のファイルが既にアップロードされています'
+            })
+            continue
+        known_hashes.add(file_hash)
+        targets.append((filename, filepath, file_hash))
+
+    # CSVの解析（大きいファイルが複数ならプロセスプールで並列に。商品名の対応表は親プロセスで読み込んで渡す）
+    mapping = get_product_mapping()
+    parsed = parse_sales_files(targets, mapping)
+
+    # DBへの登録（全ファイル分を1トランザクションで）
+    all_rows = []
+    db = get_db()
+    with db:
+        for (filename, filepath, file_hash), result in zip(targets, parsed):
+            if result['error']:
+                report.append({'filename': filename, 'status': 'error', 'message': result['error']})
+                continue
+            if not result['found_alcohol']:
+                report.append({
+                    'filename': filename, 'status': 'no_data',
+                    'message': '「お酒類」のデータは見つかりませんでした'
+                })
+                continue
+            counts, inserted_rows = store_sales_rows(db, filename, result['rows'])
+            db.execute(
+                'INSERT OR IGNORE INTO upload_log (filename, file_hash) VALUES (?, ?)',
+                (filename, file_hash)
+            )
+            record_unmapped_labels(result['unmapped'], filename)
+            all_rows.extend(inserted_rows)
+            needs_reconcile = bool(counts['updated'] or counts['deleted'])
+            entry = {
+                'filename': filename, 'status': 'success', 'rows': len(result['rows']),
+                'unmapped_labels': result['unmapped'], 'needs_reconcile': needs_reconcile, **counts
+            }
+            if needs_reconcile:
+                # 追記ジョブはバッチ全体で1つなので、ファイルごとには反映されない行の案内だけを出す
+                entry['message'] = sales_sheet_notice(counts, None)
+            report.append(entry)
+
+        # スプレッドシートへの追記（全ファイル分をまとめて1つのジョブで）
+        job_id = enqueue_sync_job('sales', {'rows': [list(row) for row in all_rows]}) if all_rows else None
+
+    return jsonify({'results': report, 'job_id': job_id}), 200
+
+
+# CSV解析用のプロセスプール（プロセスごとに1つを使い回す。fork後の子プロセスでは作り直す）
+_parse_pool = {'executor': None, 'pid': None}
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """CSV解析用のプロセスプールを取得する（初回の呼び出しで作る）
+
+    このプロセスはスレッド（gthread・ジョブワーカー）を持つので fork はせず forkserver を使う。
+    app と pandas は forkserver で一度だけ import し、プールのプロセスはそこから fork するので、
+    アップロードのたびに import し直すことはない。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _parse_pool_lock:
+        if _parse_pool['executor'] is None or _parse_pool['pid'] != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['app', 'pandas'])
+            _parse_pool['executor'] = ProcessPoolExecutor(
+                max_workers=app.config['UPLOAD_PARSE_WORKERS'], mp_context=context
+            )
+            _parse_pool['pid'] = os.getpid()
+            atexit.register(shutdown_parse_pool)
+        return _parse_pool['executor']
+
+
+def shutdown_parse_pool():
+    """プロセスの終了時にプロセスプールを止める"""
+    with _parse_pool_lock:
+        executor, _parse_pool['executor'] = _parse_pool['executor'], None
+    if executor is not None and _parse_pool['pid'] == os.getpid():
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def discard_parse_pool(executor):
+    """壊れたプロセスプールを捨てる（次回の get_parse_pool で作り直す）"""
+    with _parse_pool_lock:
+        if _parse_pool['executor'] is executor:
+            _parse_pool['executor'] = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_sales_files(targets, mapping):
+    """[(ファイル名, パス, ハッシュ値), ...] のCSVを解析して parse_sales_file の結果のリストを返す
+
+    プロセス間の受け渡しの分だけ遅くなるので、CPUが複数あり、ファイルの合計サイズが
+    UPLOAD_PARALLEL_MIN_BYTES 以上の場合だけプロセスプールで並列に解析する。
+    """
+    from concurrent.futures.process import BrokenProcessPool
+
+    parallel = (
+        len(targets) > 1
+        and app.config['UPLOAD_PARSE_WORKERS'] > 1
+        and (os.cpu_count() or 1) > 1
+        and sum(os.path.getsize(filepath) for _, filepath, _ in targets) >= app.config['UPLOAD_PARALLEL_MIN_BYTES']
+    )
+    if parallel:
+        executor = get_parse_pool()
+        try:
+            return list(executor.map(
+                parse_sales_file,
+                [filepath for _, filepath, _ in targets],
+                [filename for filename, _, _ in targets],
+                [mapping] * len(targets),
+                [app.config['CSV_CHUNK_SIZE']] * len(targets)
+            ))
+        except BrokenProcessPool:
+            logger.exception("CSV解析用のプロセスプールが停止したため、このプロセスで解析します")
+            discard_parse_pool(executor)
+    return [parse_sales_file(filepath, filename, mapping) for filename, filepath, _ in targets]
+
+
+def csv_entries_in_zip(stream):
+    """zip内のCSVを [(ファイル名, 内容を読み出すストリームを返す関数), ...] として返す（展開はしない）
+
+    macOS が付け加える __MACOSX/ フォルダや ._ で始まるファイル（リソースフォーク）は除く。
+    CSVの展開後の合計サイズが ZIP_MAX_UNCOMPRESSED_BYTES を超える場合は ValueError にする。
+    """
+    archive = zipfile.ZipFile(stream)
+    entries = []
+    total_size = 0
+    for info in archive.infolist():
+        parts = info.filename.split('/')
+        if info.is_dir() or parts[0] == '__MACOSX' or parts[-1].startswith('._'):
+            continue
+        # レジごとのフォルダに同じ名前のCSVが入っていることがあるので、フォルダ名も残す
+        # （alcohol_sales の行は元ファイル名ごとに登録・上書きされる）
+        filename = '/'.join(filter(None, (secure_filename(part) for part in parts)))
+        if not allowed_file(filename):
+            continue
+        total_size += info.file_size
+        if total_size > app.config['ZIP_MAX_UNCOMPRESSED_BYTES']:
+            raise ValueError('zipファイルの展開後のサイズが大きすぎます')
+        entries.append((filename, functools.partial(archive.open, info)))
+    return entries
+
+
+def rewound(stream):
+    """先頭に巻き戻したストリームを返す関数を作る（with 文で使っても元のストリームは閉じない）"""
+    def open_stream():
+        stream.seek(0)
+        return contextlib.nullcontext(stream)
+    return open_stream
+
+
 @app.route('/confirm_upload', methods=['POST'])
 def confirm_upload():
     """重複確認後の再アップロード処理"""
-    filename = request.form['filename']
+    filename = secure_filename(request.form['filename'])
     file_hash = request.form['file_hash']
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    
+
     try:
-        db = get_db()
-        with db:
-            db.execute('DELETE FROM alcohol_sales WHERE source_filename = ?', (filename,))
-        db.close()
+        filepath = stored_upload_path(file_hash)
+        if not os.path.exists(filepath):
+            return jsonify({'error': 'アップロードされたファイルが見つかりません。もう一度アップロードしてください。'}), 404
+        # 前回の行は UPSERT で上書きされ、今回のファイルにない行だけが削除される
         return process_and_store_csv(filepath, filename, file_hash)
     except Exception as e:
-        print(f"!!! An error occurred during re-processing: {e} !!!")
-        traceback.print_exc()
+        logger.exception("再処理中にエラーが発生しました: %s", filename)
         return jsonify({'error': f'再処理中にエラーが発生しました: {e}'}), 500
 
         return jsonify({'error': f'CSV処理中に予期せぬエラーが発生しました: {e}'}), 500
 
 
 # SQLiteのデータを表示・管理するページ
+def sales_filters_from_request():
+    """リクエストのクエリ文字列から alcohol_sales の絞り込み条件を取り出す"""
+    return {
+        'date_from': request.args.get('date_from', ''),
+        'date_to': request.args.get('date_to', ''),
+        'product': request.args.get('product', ''),
+    }
+
+
+def sales_where_clause(filters):
+    """絞り込み条件から WHERE 句とパラメータを組み立てる"""
+    conditions, params = [], []
+    if filters.get('date_from'):
+        conditions.append('date >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        conditions.append('date <= ?')
+        params.append(filters['date_to'])
+    if filters.get('product'):
+        conditions.append('product_name = ?')
+        params.append(filters['product'])
+    return conditions, params
+
+
+def query_sales_page(filters, after_date=None, after_id=None, limit=None):
+    """alcohol_sales を販売日・ID の降順でキーセットページングして取得する
+
+    前ページ最後の (販売日, ID) を渡すと、その続きから limit 件を返す。
+    戻り値は (行のリスト, 次ページの開始位置 or None)。
+    """
+    limit = min(max(limit or app.config['DATA_PAGE_SIZE'], 1), app.config['DATA_PAGE_SIZE_MAX'])
+    conditions, params = sales_where_clause(filters)
+    if after_date and after_id:
+        conditions.append('(date, id) < (?, ?)')
+        params.extend([after_date, after_id])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    db = get_db()
+    rows = db.execute(
+        f'SELECT id, date, product_name, sales_count, source_filename FROM alcohol_sales {where} '
+        f'ORDER BY date DESC, id DESC LIMIT ?',
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = {'after_date': rows[-1]['date'], 'after_id': rows[-1]['id']}
+    return rows, next_cursor
+
+
+def sales_page_from_request():
+    filters = sales_filters_from_request()
+    rows, next_cursor = query_sales_page(
+        filters,
+        after_date=request.args.get('after_date'),
+        after_id=request.args.get('after_id', type=int),
+        limit=request.args.get('limit', type=int)
+    )
+    return filters, rows, next_cursor
+
+
 @app.route('/data')
 def show_data():
+    filters, entries, next_cursor = sales_page_from_request()
+    db = get_db()
+    product_options = [
+        row['product_name'] for row in
+        db.execute('SELECT DISTINCT product_name FROM alcohol_sales ORDER BY product_name')
+    ]
+    # 続きのページも同じ件数で表示する（limit が指定されていなければ既定の件数）
+    limit = request.args.get('limit', type=int)
+    next_url = url_for('show_data', **filters, **next_cursor, limit=limit) if next_cursor else None
+    return render_template(
+        'data.html',
+        entries=entries,
+        filters=filters,
+        product_options=product_options,
+        next_url=next_url
+    )
+
+
+@app.route('/api/data')
+def show_data_json():
+    """/data と同じ条件・ページングでの JSON 版"""
+    filters, entries, next_cursor = sales_page_from_request()
+    return jsonify({
+        'entries': [dict(row) for row in entries],
+        'next_cursor': next_cursor
+    })
+
+# --- CSV / Excel エクスポート ---
+# 行は SQLite のカーソルから EXPORT_FETCH_SIZE 行ずつ取り出して書き出すので、
+# 何年分のデータでもメモリ使用量は一定になる。
+
+SALES_EXPORT_HEADER = ['ID', '販売日', '商品名', '販売数', '元ファイル名']
+LEDGER_EXPORT_HEADER = ['出庫ID', '出庫日', '出庫先', '取引先', '担当者', '商品名', '数量']
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def iter_query_batches(query, params):
+    """SQL の結果を EXPORT_FETCH_SIZE 行ずつのリストで返す"""
+    cursor = get_db().execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(app.config['EXPORT_FETCH_SIZE'])
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def csv_export_response(filename, header, query, params):
+    """SQL の結果を CSV として少しずつ送るレスポンス（Excel で開けるよう BOM 付き UTF-8）"""
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(header)
+        # ヘッダーは最初の行を読む前に送り、ダウンロードをすぐに始める
+        yield buffer.getvalue()
+        for rows in iter_query_batches(query, params):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(tuple(row) for row in rows)
+            yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+def xlsx_export_response(filename, sheet_title, header, query, params):
+    """SQL の結果を Excel ファイルにして返す
+
+    openpyxl の書き込み専用モードで行を一時ファイルに書き出すため、メモリ使用量は行数によらない。
+    （xlsx は zip 形式で最後に目次を書くため、CSV と違い書き終えてから送り始める）
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_title)
+    worksheet.append(header)
+    for rows in iter_query_batches(query, params):
+        for row in rows:
+            worksheet.append(list(row))
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return send_file(output, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename)
+
+
+def export_response(fmt, basename, sheet_title, header, query, params):
+    filename = f"{basename}-{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    if fmt == 'xlsx':
+        return xlsx_export_response(filename, sheet_title, header, query, params)
+    return csv_export_response(filename, header, query, params)
+
+
+@app.route('/export/sales.<any(csv, xlsx):fmt>')
+def export_sales(fmt):
+    """alcohol_sales を /data と同じ絞り込み条件で CSV / Excel に書き出す"""
+    conditions, params = sales_where_clause(sales_filters_from_request())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = (
+        f'SELECT id, date, product_name, sales_count, source_filename FROM alcohol_sales {where} '
+        f'ORDER BY date, id'
+    )
+    return export_response(fmt, 'alcohol-sales', '売上データ', SALES_EXPORT_HEADER, query, params)
+
+
+@app.route('/export/ledger.<any(csv, xlsx):fmt>')
+def export_ledger(fmt):
+    """出庫台帳（出庫情報×出庫詳細、1行1商品）を /list と同じ絞り込み条件で CSV / Excel に書き出す"""
+    ensure_sheet_mirror()
+    conditions, params = shukko_where_clause(shukko_filters_from_request())
+    where = f"WHERE {' AND '.join('i.' + condition for condition in conditions)}" if conditions else ''
+    query = (
+        'SELECT i.shukko_id, i.shukko_date, i.destination, i.client, i.staff, d.product_name, d.quantity '
+        'FROM shukko_info_mirror AS i '
+        'LEFT JOIN shukko_detail_mirror AS d ON d.shukko_id = i.shukko_id '
+        f'{where} '
+        'ORDER BY i.shukko_date, i.shukko_id, d.row_number IS NULL, d.row_number, d.id'
+    )
+    return export_response(fmt, 'shukko-ledger', '出庫台帳', LEDGER_EXPORT_HEADER, query, params)
+
+
+# 売上集計（日別・月別×商品の集計テーブルから返す）
+def query_sales_summary(granularity, period_from='', period_to='', product=''):
+    """集計テーブルから期間×商品の販売数を取得する
+
+    granularity は 'month'（YYYY-MM）または 'day'（YYYY-MM-DD）。
+    戻り値は (期間のリスト, 商品名のリスト, {商品名: {期間: 販売数}}, {期間: 合計})。
+    """
+    if granularity == 'day':
+        table, period_column = 'sales_daily_summary', 'date'
+    else:
+        table, period_column = 'sales_monthly_summary', 'month'
+
+    conditions, params = [], []
+    if period_from:
+        conditions.append(f'{period_column} >= ?')
+        params.append(period_from)
+    if period_to:
+        conditions.append(f'{period_column} <= ?')
+        params.append(period_to)
+    if product:
+        conditions.append('product_name = ?')
+        params.append(product)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
     db = get_db()
-    entries = db.execute('SELECT id, date, product_name, sales_count, source_filename FROM alcohol_sales ORDER BY date DESC, id DESC').fetchall()
-    db.close()
-    return render_template('data.html', entries=entries)
+    rows = db.execute(
+        f'SELECT {period_column} AS period, product_name, total_count FROM {table} {where} '
+        f'ORDER BY {period_column}, product_name',
+        params
+    ).fetchall()
+
+    periods, products = [], []
+    table_data, totals = {}, {}
+    for row in rows:
+        if row['period'] not in totals:
+            periods.append(row['period'])
+            totals[row['period']] = 0
+        if row['product_name'] not in table_data:
+            products.append(row['product_name'])
+            table_data[row['product_name']] = {}
+        table_data[row['product_name']][row['period']] = row['total_count']
+        totals[row['period']] += row['total_count']
+    return periods, sorted(products), table_data, totals
+
+
+def sales_summary_from_request():
+    granularity = 'day' if request.args.get('granularity') == 'day' else 'month'
+    params = {
+        'granularity': granularity,
+        'period_from': request.args.get('from', ''),
+        'period_to': request.args.get('to', ''),
+        'product': request.args.get('product', ''),
+    }
+    return params, query_sales_summary(**params)
+
+
+@app.route('/reports')
+def reports():
+    """売上集計ページ（月別・日別×商品）"""
+    params, (periods, products, table_data, totals) = sales_summary_from_request()
+    db = get_db()
+    product_options = [
+        row['product_name'] for row in
+        db.execute('SELECT DISTINCT product_name FROM sales_monthly_summary ORDER BY product_name')
+    ]
+    return render_template(
+        'reports.html',
+        params=params,
+        periods=periods,
+        products=products,
+        table_data=table_data,
+        totals=totals,
+        product_options=product_options
+    )
+
+
+@app.route('/api/reports')
+def reports_json():
+    """/reports と同じ条件での JSON 版"""
+    params, (periods, products, table_data, totals) = sales_summary_from_request()
+    return jsonify({
+        'granularity': params['granularity'],
+        'periods': periods,
+        'products': [
+            {'product_name': product, 'counts': table_data[product], 'total': sum(table_data[product].values())}
+            for product in products
+        ],
+        'totals': totals
+    })
+
 
 @app.route('/delete/<int:id>', methods=['POST'])
 def delete_entry(id):
     db = get_db()
     with db:
         db.execute('DELETE FROM alcohol_sales WHERE id = ?', (id,))
-    db.close()
     return redirect(url_for('show_data'))
 
 @app.route('/delete_all', methods=['POST'])
@@ -547,10 +3312,138 @@ def delete_all_entries():
     with db:
         db.execute('DELETE FROM alcohol_sales')
         db.execute('DELETE FROM upload_log')
-    db.close()
     return redirect(url_for('show_data'))
 
 
+# 商品名の対応表（POS商品名 → 台帳の商品名）の管理ページ
+@app.route('/mappings', methods=['GET', 'POST'])
+def product_mappings():
+    if request.method == 'POST':
+        pos_label = request.form.get('pos_label', '').strip()
+        product_name = request.form.get('product_name', '').strip()
+        if pos_label and product_name:
+            save_product_mapping(pos_label, product_name)
+        return redirect(url_for('product_mappings'))
+
+    db = get_db()
+    mappings = db.execute(
+        'SELECT label_key, pos_label, product_name, updated_at FROM product_name_mapping ORDER BY product_name, label_key'
+    ).fetchall()
+    unmapped = db.execute(
+        'SELECT label_key, pos_label, last_filename, seen_count, last_seen_at FROM unmapped_product_labels '
+        'ORDER BY last_seen_at DESC'
+    ).fetchall()
+    product_names = sorted({row['product_name'] for row in mappings})
+    return render_template('mappings.html', mappings=mappings, unmapped=unmapped, product_names=product_names)
+
+
+@app.route('/mappings/delete', methods=['POST'])
+def delete_mapping():
+    delete_product_mapping(request.form['label_key'])
+    return redirect(url_for('product_mappings'))
+
+
+# === 運用・監視 ===
+
+@app.before_request
+def ensure_database():
+    ensure_db_schema()
+
+
+@app.before_request
+def ensure_sync_worker():
+    # 再起動前に積まれたジョブも処理されるよう、最初のリクエストでワーカーを起動する
+    start_sync_worker()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_timings = defaultdict(float)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """ルートごとの処理時間を記録し、設定があれば Server-Timing ヘッダーで内訳を返す"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    observe('http_request_duration_seconds', elapsed,
+            method=request.method, route=route, status=response.status_code)
+    if app.config['TIMING_HEADER']:
+        timings = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in g.request_timings.items()]
+        timings.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """処理時間・API呼び出し回数のメトリクス（Prometheus のテキスト形式）"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """スプレッドシート反映ジョブの状態（JSON）"""
+    job = get_sync_job(job_id)
+    if job is None:
+        return jsonify({'error': '指定されたジョブが見つかりません'}), 404
+    status = dict(job)
+    status['result'] = json.loads(job['result']) if job['result'] else None
+    return jsonify(status)
+
+
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """失敗したスプレッドシート反映ジョブを再実行する（JSON）"""
+    if get_sync_job(job_id) is None:
+        return jsonify({'error': '指定されたジョブが見つかりません'}), 404
+    if not requeue_sync_job(job_id):
+        return jsonify({'error': '再実行できるのは失敗したジョブだけです'}), 409
+    return job_status(job_id)
+
+
+@app.route('/reconcile', methods=['GET', 'POST'])
+def reconcile():
+    """売上データと出庫台帳の突き合わせ（JSON）
+
+    GET は差分を返すだけ。POST で apply=1 ならシートにない売上を追記し、delete_extra=1 なら売上にない行を削除する。
+    """
+    params = request.values
+    try:
+        report = reconcile_sales_ledger(
+            params.get('date_from', ''),
+            params.get('date_to', ''),
+            apply=request.method == 'POST' and params.get('apply') == '1',
+            delete_extra=request.method == 'POST' and params.get('delete_extra') == '1'
+        )
+    except ReconcileConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("売上データと出庫台帳の突き合わせ中にエラーが発生しました")
+        return jsonify({'error': f'突き合わせ中にエラーが発生しました: {e}'}), 500
+    return jsonify(report)
+
+
+@app.route('/master-data/invalidate', methods=['POST'])
+def master_data_invalidate():
+    """プルダウン用マスタデータのキャッシュを破棄する（マスタシートを編集した直後に使う）"""
+    version = invalidate_master_data()
+    return jsonify({'success': 'マスタデータのキャッシュを破棄しました。次回の表示時にシートから取り直します。', 'version': version})
+
+
+@app.route('/sheets/stats')
+def sheets_stats_view():
+    """Google Sheets共有セッションの統計情報（JSON）"""
+    return jsonify(get_sheets_stats())
+
+
 # --- 4. アプリケーションの実行 ---
 if __name__ == '__main__':
+    ensure_db_schema()
     app.run(debug=True)
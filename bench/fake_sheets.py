@@ -0,0 +1,228 @@
+"""ベンチマーク用の Google スプレッドシートの代わり（プロセス内で動く偽のバックエンド）
+
+app.py が使う gspread の操作（open / worksheet / col_values / append_rows / update /
+values_batch_get / batch_update など）だけを、メモリ上の二次元リストに対して実装する。
+1回の呼び出しごとに遅延を入れたり、一定の割合でクォータ超過（429）を返したりできる。
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import gspread
+
+
+class _QuotaExceededResponse:
+    """gspread.exceptions.APIError に渡すための 429 レスポンスの代わり"""
+    status_code = 429
+    text = 'Quota exceeded'
+
+    def json(self):
+        return {'error': {'code': 429, 'message': 'Quota exceeded (fake)', 'status': 'RESOURCE_EXHAUSTED'}}
+
+
+class _Cell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + (ord(letter) - ord('A') + 1)
+    return index - 1
+
+
+def _cell_text(cell):
+    value = cell.get('userEnteredValue', {})
+    if 'numberValue' in value:
+        number = value['numberValue']
+        return str(int(number)) if float(number).is_integer() else str(number)
+    return str(value.get('stringValue', ''))
+
+
+class FakeSheetsBackend:
+    """偽のスプレッドシート本体と、呼び出し回数・遅延・クォータ超過の設定"""
+
+    def __init__(self, sheets, latency=0.0, quota_error_rate=0.0, seed=0):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.calls = Counter()
+        self.quota_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self.spreadsheet = FakeSpreadsheet(self, sheets)
+
+    def call(self, operation):
+        """API 呼び出し1回分の処理（回数の記録・遅延・クォータ超過の発生）"""
+        with self._lock:
+            self.calls[operation] += 1
+            quota_error = self._random.random() < self.quota_error_rate
+            if quota_error:
+                self.quota_errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if quota_error:
+            raise gspread.exceptions.APIError(_QuotaExceededResponse())
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+
+class FakeWorksheet:
+    def __init__(self, backend, sheet_id, title, rows):
+        self.backend = backend
+        self.id = sheet_id
+        self.title = title
+        self.rows = [list(map(str, row)) for row in rows]
+
+    def col_values(self, col):
+        self.backend.call('col_values')
+        with self.backend._lock:
+            return [row[col - 1] if len(row) >= col else '' for row in self.rows]
+
+    def get_all_values(self):
+        self.backend.call('get_all_values')
+        with self.backend._lock:
+            return [list(row) for row in self.rows]
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self.backend.call('append_rows')
+        with self.backend._lock:
+            start = len(self.rows) + 1
+            self.rows.extend([list(map(str, row)) for row in values])
+        end = start + len(values) - 1
+        return {'updates': {'updatedRange': f"'{self.title}'!A{start}:E{end}", 'updatedRows': len(values)}}
+
+    def update(self, range_name, values, **kwargs):
+        self.backend.call('update')
+        match = re.match(r'([A-Z]+)(\d+)', range_name)
+        col, row_number = _column_index(match.group(1)), int(match.group(2))
+        with self.backend._lock:
+            for offset, row_values in enumerate(values):
+                self._write(row_number - 1 + offset, col, row_values)
+
+    def update_cell(self, row, col, value):
+        self.backend.call('update')
+        with self.backend._lock:
+            self._write(row - 1, col - 1, [value])
+
+    def find(self, query):
+        self.backend.call('find')
+        with self.backend._lock:
+            for row_index, row in enumerate(self.rows):
+                for col_index, value in enumerate(row):
+                    if value == str(query):
+                        return _Cell(row_index + 1, col_index + 1, value)
+        return None
+
+    def delete_rows(self, start_index, end_index=None):
+        self.backend.call('delete_rows')
+        with self.backend._lock:
+            del self.rows[start_index - 1:(end_index or start_index)]
+
+    def _write(self, row_index, col, values):
+        while len(self.rows) <= row_index:
+            self.rows.append([])
+        row = self.rows[row_index]
+        while len(row) < col + len(values):
+            row.append('')
+        for offset, value in enumerate(values):
+            row[col + offset] = str(value)
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, sheets):
+        self.backend = backend
+        self.worksheets = {}
+        for sheet_id, (title, rows) in enumerate(sheets.items(), start=1):
+            self.worksheets[title] = FakeWorksheet(backend, sheet_id, title, rows)
+
+    def worksheet(self, title):
+        self.backend.call('worksheet')
+        return self.worksheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        self.backend.call('values_batch_get')
+        value_ranges = []
+        with self.backend._lock:
+            for range_name in ranges:
+                value_ranges.append({'range': range_name, 'values': self._read_range(range_name)})
+        return {'valueRanges': value_ranges}
+
+    def _read_range(self, range_name):
+        match = re.match(r"'(.+)'(?:!([A-Z]+)(\d+)?(?::([A-Z]+)(\d+)?)?)?$", range_name)
+        rows = self.worksheets[match.group(1)].rows
+        if not match.group(2):
+            return [list(row) for row in rows]
+        first_col = _column_index(match.group(2))
+        last_col = _column_index(match.group(4) or match.group(2))
+        first_row = int(match.group(3) or 1)
+        last_row = int(match.group(5)) if match.group(5) else len(rows)
+        values = [row[first_col:last_col + 1] for row in rows[first_row - 1:last_row]]
+        # 実際の API と同じく、末尾の空行は返さない
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def batch_update(self, body):
+        self.backend.call('batch_update')
+        by_id = {worksheet.id: worksheet for worksheet in self.worksheets.values()}
+        with self.backend._lock:
+            for request in body['requests']:
+                if 'deleteDimension' in request:
+                    range_ = request['deleteDimension']['range']
+                    del by_id[range_['sheetId']].rows[range_['startIndex']:range_['endIndex']]
+                elif 'insertDimension' in request:
+                    range_ = request['insertDimension']['range']
+                    rows = by_id[range_['sheetId']].rows
+                    rows[range_['startIndex']:range_['startIndex']] = [
+                        [] for _ in range(range_['endIndex'] - range_['startIndex'])
+                    ]
+                elif 'updateCells' in request:
+                    update = request['updateCells']
+                    worksheet = by_id[update['start']['sheetId']]
+                    for offset, row in enumerate(update['rows']):
+                        worksheet._write(
+                            update['start']['rowIndex'] + offset,
+                            update['start']['columnIndex'],
+                            [_cell_text(cell) for cell in row['values']]
+                        )
+                elif 'appendCells' in request:
+                    append = request['appendCells']
+                    by_id[append['sheetId']].rows.extend(
+                        [[_cell_text(cell) for cell in row['values']] for row in append['rows']]
+                    )
+                else:
+                    raise NotImplementedError(f'未対応の batch_update リクエストです: {list(request)}')
+        return {'replies': []}
+
+
+class FakeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open(self, title):
+        self.backend.call('open')
+        return self.backend.spreadsheet
+
+
+def install(app_module, backend):
+    """app.py の Sheets 接続を偽のバックエンドに差し替える（認証情報は不要になる）
+
+    app.py は gspread を関数の中で import するので、gspread モジュール側の authorize を置き換える。
+    """
+    gspread.authorize = lambda credentials, **kwargs: FakeClient(backend)
+    app_module.load_google_credentials = lambda: None
+    app_module.reset_sheets_session()
@@ -0,0 +1,98 @@
+"""app.py の import にかかる時間の確認
+
+新しいプロセスで `python -X importtime -c "import app"` を実行し、app の import 全体の時間と
+時間のかかったモジュールを表示する。起動時に読み込まないはずの重い依存関係
+（pandas・gspread・oauth2client・openpyxl）が読み込まれていたり、予算を超えていたりしたら
+終了コード 1 で終わる。
+
+使い方（リポジトリのルートで実行）:
+
+    python bench/import_time.py
+    python bench/import_time.py --budget-ms 250 --top 20
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# 起動時には読み込まず、使う関数の中で import するモジュール
+LAZY_MODULES = ('pandas', 'gspread', 'oauth2client', 'openpyxl')
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure(runs):
+    """app を import する子プロセスを runs 回実行し、最も速かった回の結果を返す"""
+    script = (
+        'import sys; sys.path.insert(0, {root!r}); import app; '
+        'print("LOADED " + " ".join(sorted(m for m in {lazy!r} if m in sys.modules)))'
+    ).format(root=REPO_ROOT, lazy=LAZY_MODULES)
+    best = None
+    for _ in range(runs):
+        # database.db などを作らないよう、一時ディレクトリで実行する
+        with tempfile.TemporaryDirectory() as workdir:
+            completed = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', script],
+                cwd=workdir, capture_output=True, text=True, check=True
+            )
+        modules = []
+        for line in completed.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, name = match.groups()
+                modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+        total_us = next(cumulative for name, _, cumulative, depth in modules if name == 'app' and depth == 0)
+        loaded = completed.stdout.split('LOADED', 1)[1].split()
+        if best is None or total_us < best[0]:
+            best = (total_us, modules, loaded)
+    return best
+
+
+def direct_imports(modules):
+    """app が直接 import したモジュールを累積時間の長い順に返す
+
+    -X importtime の出力は子モジュールが親より先に並ぶので、app の行の直前にある
+    1段下のモジュールが app の直接の import にあたる。
+    """
+    app_index = next(i for i, (name, _, _, depth) in enumerate(modules) if name == 'app' and depth == 0)
+    children = []
+    for name, _, cumulative_us, depth in reversed(modules[:app_index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            children.append((name, cumulative_us))
+    return sorted(children, key=lambda child: child[1], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='app.py の import 時間を確認する')
+    parser.add_argument('--budget-ms', type=float, default=400.0, help='app の import にかけてよい時間（ミリ秒）')
+    parser.add_argument('--runs', type=int, default=3, help='計測回数（最も速かった回で判定する）')
+    parser.add_argument('--top', type=int, default=15, help='表示する時間のかかったモジュールの数')
+    args = parser.parse_args()
+
+    total_us, modules, loaded = measure(args.runs)
+    print(f'app の import: {total_us / 1000:.1f} ms（予算 {args.budget_ms:.0f} ms）')
+    print('時間のかかったモジュール（直下の import 単位・累積）:')
+    for name, cumulative_us in direct_imports(modules)[:args.top]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
+
+    failed = False
+    if loaded:
+        print(f'[NG] 起動時に読み込まないはずのモジュールが読み込まれています: {", ".join(loaded)}')
+        failed = True
+    if total_us / 1000 > args.budget_ms:
+        print('[NG] import 時間が予算を超えています')
+        failed = True
+    if not failed:
+        print('[OK]')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
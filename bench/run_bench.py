@@ -0,0 +1,351 @@
+"""オフラインのベンチマーク
+
+実際のスプレッドシートの代わりにプロセス内の偽バックエンド（bench/fake_sheets.py）を使い、
+合成した台帳・売上CSVに対して主要な画面・処理を並列に実行して、
+レイテンシ・Sheets API の呼び出し回数・SQLite の実行回数・ピークメモリを計測する。
+
+使い方（リポジトリのルートで実行）:
+
+    python bench/run_bench.py
+    python bench/run_bench.py --ledger-rows 1000 100000 --csv-rows 50000 --concurrency 8
+    python bench/run_bench.py --latency 0.2 --quota-error-rate 0.05
+    python bench/run_bench.py --check bench/call_budget.json
+
+結果は標準出力と bench_output.txt（--output で変更可）に追記する。
+--check を付けると、1リクエストあたりの API 呼び出し回数が上限を超えたシナリオがあれば終了コード 1 で終わる。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='在庫管理システムのオフラインベンチマーク')
+    parser.add_argument('--ledger-rows', type=int, nargs='+', default=[1000],
+                        help='出庫情報シートの行数（複数指定するとそれぞれで計測）')
+    parser.add_argument('--csv-rows', type=int, default=10000, help='アップロードする売上CSV1件あたりの行数')
+    parser.add_argument('--requests', type=int, default=20, help='シナリオごとのリクエスト数')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に実行するリクエスト数')
+    parser.add_argument('--latency', type=float, default=0.0, help='Sheets API 呼び出し1回あたりの遅延（秒）')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0,
+                        help='Sheets API 呼び出しがクォータ超過（429）になる割合')
+    parser.add_argument('--scenarios', nargs='+', default=None, help='実行するシナリオ（省略時はすべて）')
+    parser.add_argument('--no-memory', action='store_true', help='tracemalloc によるピークメモリの計測をしない')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(REPO_ROOT, 'bench_output.txt'))
+    parser.add_argument('--json', help='結果をJSONでも保存するパス')
+    parser.add_argument('--check', help='シナリオごとの1リクエストあたりの API 呼び出し回数の上限（JSON）')
+    return parser.parse_args()
+
+
+def import_app(workdir):
+    """作業用の一時ディレクトリで app.py を読み込む（リポジトリの database.db には触れない）"""
+    os.chdir(workdir)
+    os.environ.setdefault('SYNC_WORKER_ENABLED', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    import app
+    return app
+
+
+class Bench:
+    """台帳の大きさ1つ分の計測（DB・アップロード先・偽バックエンドを新しく用意する）"""
+
+    def __init__(self, app_module, args, ledger_rows, workdir):
+        import fake_sheets
+        import synthetic
+
+        self.app = app_module
+        self.args = args
+        self.ledger_rows = ledger_rows
+        self.rng = random.Random(args.seed)
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        self._counter = 0
+
+        app_config = app_module.app.config
+        app_config['DATABASE'] = os.path.join(workdir, f'bench-{ledger_rows}.db')
+        app_config['UPLOAD_FOLDER'] = os.path.join(workdir, f'uploads-{ledger_rows}')
+        app_config['MASTER_DATA_CACHE_FILE'] = os.path.join(workdir, f'master-{ledger_rows}.json')
+        app_config['SYNC_WORKER_ENABLED'] = False
+        os.makedirs(app_config['UPLOAD_FOLDER'], exist_ok=True)
+        app_module._db_schema['ready'] = False
+        app_module.ensure_db_schema()
+        # 前の計測のプロセス内キャッシュを捨てる
+        app_module._master_data.update(values=None, fetched_at=0.0, version=None, disk_loaded=False)
+        app_module._product_mapping_cache.update(version=None, mapping={})
+
+        self.product_names = sorted(set(app_module.PRODUCT_NAME_MAPPING.values()))
+        self.pos_labels = sorted(app_module.PRODUCT_NAME_MAPPING)
+        sheets, self.shukko_ids = synthetic.ledger_sheets(ledger_rows, self.product_names, seed=args.seed)
+        self.synthetic = synthetic
+        self.backend = fake_sheets.FakeSheetsBackend(
+            sheets, latency=args.latency, quota_error_rate=args.quota_error_rate, seed=args.seed
+        )
+        fake_sheets.install(app_module, self.backend)
+
+    # --- 共通処理 ---
+
+    def client(self):
+        """スレッドごとのテストクライアント"""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.app.test_client()
+        return client
+
+    def next_number(self):
+        with self._counter_lock:
+            self._counter += 1
+            return self._counter
+
+    def sqlite_queries(self):
+        histograms = self.app._histograms.get('sqlite_query_duration_seconds', {})
+        with self.app._metrics_lock:
+            return sum(series['count'] for series in histograms.values())
+
+    def run(self, name, func, n_requests, concurrency, prepare=None):
+        """func(i) を n_requests 回（concurrency 並列で）実行して計測結果を返す"""
+        payloads = [prepare(i) for i in range(n_requests)] if prepare else list(range(n_requests))
+        trace_memory = not self.args.no_memory
+        if trace_memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        calls_before = self.backend.snapshot()
+        quota_before = self.backend.quota_errors
+        queries_before = self.sqlite_queries()
+
+        def timed_call(payload):
+            started = time.perf_counter()
+            ok = func(payload)
+            return time.perf_counter() - started, ok
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(timed_call, payloads))
+        elapsed = time.perf_counter() - started
+
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        calls = self.backend.snapshot()
+        calls.subtract(calls_before)
+        calls = {operation: count for operation, count in calls.items() if count}
+        latencies = sorted(latency for latency, _ in outcomes)
+        total_calls = sum(calls.values())
+        return {
+            'scenario': name,
+            'ledger_rows': self.ledger_rows,
+            'requests': n_requests,
+            'concurrency': concurrency,
+            'errors': sum(1 for _, ok in outcomes if not ok),
+            'seconds': elapsed,
+            'requests_per_second': n_requests / elapsed if elapsed else None,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'api_calls': total_calls,
+            'api_calls_per_request': total_calls / n_requests,
+            'api_calls_by_operation': calls,
+            'quota_errors': self.backend.quota_errors - quota_before,
+            'sqlite_queries_per_request': (self.sqlite_queries() - queries_before) / n_requests,
+            'peak_memory_mb': peak / 1024 / 1024 if peak is not None else None,
+        }
+
+    # --- シナリオ ---
+
+    def mirror_refresh(self):
+        def request_list(_):
+            with self.app.app.app_context():
+                self.app.mark_sheet_mirror_stale()
+            return self.client().get('/list').status_code == 200
+        return self.run('mirror_refresh', request_list, 1, 1)
+
+    def list(self):
+        queries = ['/list', '/list?sort=id&order=asc', '/list?destination=A店', '/list?staff=北沢&date_from=2020-02-01']
+
+        def request_list(i):
+            return self.client().get(queries[i % len(queries)]).status_code == 200
+        return self.run('list', request_list, self.args.requests, self.args.concurrency)
+
+    def detail(self):
+        def request_detail(shukko_id):
+            return self.client().get(f'/detail/{shukko_id}').status_code == 200
+        return self.run('detail', request_detail, self.args.requests, self.args.concurrency,
+                        prepare=lambda i: self.rng.choice(self.shukko_ids))
+
+    def register(self):
+        def request_register(i):
+            form = {
+                'date': date.today().isoformat(),
+                'destination': self.synthetic.DESTINATIONS[i % len(self.synthetic.DESTINATIONS)],
+                'staff': self.synthetic.STAFF[i % len(self.synthetic.STAFF)],
+                'client': '',
+                'item1': self.product_names[i % len(self.product_names)],
+                'qty1': str(i % 12 + 1),
+            }
+            response = self.client().post('/register', data=form)
+            return response.status_code == 200
+        return self.run('register', request_register, self.args.requests, self.args.concurrency)
+
+    def register_form(self):
+        def request_form(_):
+            return self.client().get('/register').status_code == 200
+        return self.run('register_form', request_form, self.args.requests, self.args.concurrency)
+
+    def edit_detail(self):
+        def request_edit(shukko_id):
+            client = self.client()
+            page = client.get(f'/edit-detail/{shukko_id}').get_data(as_text=True)
+            form = dict(re.findall(r'name="((?:item|qty)\d+)" value="([^"]*)"', page))
+            form['token'] = re.search(r'name="token" value="(\w+)"', page).group(1)
+            form['line_count'] = re.search(r'name="line_count" value="(\d+)"', page).group(1)
+            form['qty1'] = str(int(form.get('qty1') or 0) + 1)
+            return client.post(f'/edit-detail/{shukko_id}', data=form).status_code == 200
+
+        # 同じ出庫を同時に編集すると楽観的排他制御で 409 になるため、別々の出庫を選ぶ
+        targets = self.rng.sample(self.shukko_ids, min(self.args.requests, len(self.shukko_ids)))
+        return self.run('edit_detail', request_edit, len(targets), self.args.concurrency,
+                        prepare=lambda i: targets[i])
+
+    def upload(self):
+        def prepare(i):
+            day = date(2030, 1, 1) + timedelta(days=self.next_number())
+            content = self.synthetic.pos_csv_bytes(self.args.csv_rows, self.pos_labels, seed=self.args.seed + i)
+            return f"{day.strftime('%Y%m%d')}-uriage.csv", content
+
+        def request_upload(payload):
+            filename, content = payload
+            response = self.client().post(
+                '/upload', data={'file': (io.BytesIO(content), filename)}, content_type='multipart/form-data'
+            )
+            return response.status_code == 200
+
+        n_requests = max(1, self.args.requests // 4)
+        return self.run('upload', request_upload, n_requests, self.args.concurrency, prepare=prepare)
+
+    def data(self):
+        queries = ['/data', '/data?limit=500', '/api/data?date_from=2030-01-01', '/reports']
+
+        def request_data(i):
+            return self.client().get(queries[i % len(queries)]).status_code == 200
+        return self.run('data', request_data, self.args.requests, self.args.concurrency)
+
+    def sync_jobs(self):
+        """溜まったスプレッドシート反映ジョブを1つのスレッドで処理しきる"""
+        def drain(_):
+            with self.app.app.app_context():
+                while True:
+                    job = self.app.claim_sync_job()
+                    if job is None:
+                        return True
+                    self.app.run_sync_job(job)
+
+        with self.app.app.app_context():
+            pending = self.app.get_db().execute(
+                "SELECT COUNT(*) FROM sync_jobs WHERE status = 'pending'"
+            ).fetchone()[0]
+        result = self.run('sync_jobs', drain, 1, 1)
+        result['jobs'] = pending
+        result['api_calls_per_job'] = result['api_calls'] / pending if pending else 0.0
+        return result
+
+
+SCENARIOS = [
+    'mirror_refresh', 'list', 'detail', 'register_form', 'register', 'edit_detail', 'upload', 'data', 'sync_jobs',
+]
+
+
+def format_result(result):
+    operations = ', '.join(f'{op}={count}' for op, count in sorted(result['api_calls_by_operation'].items()))
+    peak = f"{result['peak_memory_mb']:.1f}MB" if result['peak_memory_mb'] is not None else '-'
+    return (
+        f"{result['scenario']:<15} rows={result['ledger_rows']:<8} n={result['requests']:<4} "
+        f"err={result['errors']:<3} p50={result['p50_ms']:8.1f}ms p95={result['p95_ms']:8.1f}ms "
+        f"rps={result['requests_per_second'] or 0:7.1f} api/req={result['api_calls_per_request']:6.2f} "
+        f"sql/req={result['sqlite_queries_per_request']:7.1f} peak={peak} [{operations}]"
+    )
+
+
+def check_budget(results, budget_path):
+    """1リクエストあたりの API 呼び出し回数が上限を超えたシナリオの一覧を返す"""
+    with open(budget_path, encoding='utf-8') as f:
+        budget = json.load(f)
+    violations = []
+    for result in results:
+        limit = budget.get(result['scenario'])
+        if limit is None:
+            continue
+        value = result.get('api_calls_per_job', result['api_calls_per_request'])
+        if value > limit:
+            violations.append(
+                f"{result['scenario']}（{result['ledger_rows']} 行）: {value:.2f} 回/件 > 上限 {limit}"
+            )
+    return violations
+
+
+def main():
+    args = parse_args()
+    scenarios = args.scenarios or SCENARIOS
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f'不明なシナリオです: {sorted(unknown)}')
+
+    # app.py は一時ディレクトリで動かすので、指定されたパスは先に絶対パスにしておく
+    for name in ('output', 'json', 'check'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    workdir = tempfile.mkdtemp(prefix='inventory-bench-')
+    app_module = import_app(workdir)
+
+    header = (
+        f"# {datetime.now().isoformat(timespec='seconds')} ledger_rows={args.ledger_rows} csv_rows={args.csv_rows} "
+        f"requests={args.requests} concurrency={args.concurrency} latency={args.latency} "
+        f"quota_error_rate={args.quota_error_rate}"
+    )
+    print(header)
+    lines = [header]
+    results = []
+    for ledger_rows in args.ledger_rows:
+        bench = Bench(app_module, args, ledger_rows, workdir)
+        for name in SCENARIOS:
+            if name not in scenarios:
+                continue
+            result = getattr(bench, name)()
+            results.append(result)
+            line = format_result(result)
+            print(line, flush=True)
+            lines.append(line)
+
+    violations = check_budget(results, args.check) if args.check else []
+    for violation in violations:
+        line = f'[BUDGET] {violation}'
+        print(line)
+        lines.append(line)
+
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n\n')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""ベンチマーク用の合成データ（POSの売上CSVと出庫台帳のシート）"""
+import random
+from datetime import date, timedelta
+
+DESTINATIONS = ['店頭販売', 'A店', 'B店', 'C酒店', 'Dマルシェ', 'イベント']
+STAFF = ['北沢', '佐藤', '鈴木', '高橋']
+OTHER_CATEGORIES = ['食品', '雑貨', 'ドリンク']
+# 対応表にない（未登録一覧に載る）商品名
+UNMAPPED_LABELS = ['季節限定シードル 1500円', '試飲用ワイン']
+
+
+def pos_label_variants(label, rng):
+    """対応表の商品名から、全角・半角や空白、価格表記の揺れを加えた商品名を作る"""
+    variant = label
+    if rng.random() < 0.3:
+        variant = variant.replace('　', ' ')
+    if rng.random() < 0.2:
+        variant = variant.translate(str.maketrans('0123456789', '０１２３４５６７８９'))
+    if rng.random() < 0.1:
+        variant = variant + ' '
+    return variant
+
+
+def pos_csv_bytes(n_rows, product_labels, seed=0, alcohol_ratio=0.3, unmapped_ratio=0.02):
+    """スマレジの売上CSVと同じ列構成（A列: 商品名, B列: 部門, H列: 販売数）のCSVを cp932 で作る"""
+    rng = random.Random(seed)
+    lines = ['商品名,部門,商品コード,単価,割引,税区分,備考,販売数']
+    for index in range(n_rows):
+        if rng.random() < alcohol_ratio:
+            category = 'お酒類'
+            if rng.random() < unmapped_ratio:
+                label = rng.choice(UNMAPPED_LABELS)
+            else:
+                label = pos_label_variants(rng.choice(product_labels), rng)
+        else:
+            category = rng.choice(OTHER_CATEGORIES)
+            label = f'商品{index % 500}'
+        lines.append(f'{label},{category},{index},1000,0,10,,{rng.randint(1, 12)}')
+    return ('\n'.join(lines) + '\n').encode('cp932')
+
+
+def ledger_sheets(n_rows, product_names, seed=0, rows_per_day=50, start=date(2020, 1, 1)):
+    """出庫情報 n_rows 行（出庫詳細は1件あたり1〜3行）とマスタシートを作る
+
+    戻り値は {シート名: 行のリスト（1行目はヘッダー）} と、作成した出庫IDのリスト。
+    """
+    rng = random.Random(seed)
+    info = [['出庫ID', '出庫日', '出庫先', '取引先', '担当者']]
+    details = [['出庫ID', '商品名', '数量']]
+    shukko_ids = []
+    for index in range(n_rows):
+        day = start + timedelta(days=index // rows_per_day)
+        shukko_id = f"{day.strftime('%y%m%d')}-{index % rows_per_day + 1:03d}"
+        shukko_ids.append(shukko_id)
+        info.append([shukko_id, day.isoformat(), rng.choice(DESTINATIONS), '', rng.choice(STAFF)])
+        for _ in range(rng.randint(1, 3)):
+            details.append([shukko_id, rng.choice(product_names), str(rng.randint(1, 24))])
+
+    sheets = {
+        '出庫情報': info,
+        '出庫詳細': details,
+        '出庫先': [['出庫先']] + [[name] for name in DESTINATIONS],
+        '商品名': [['商品名']] + [[name] for name in product_names],
+        'スタッフ': [['スタッフ']] + [[name] for name in STAFF],
+    }
+    return sheets, shukko_ids
@@ -0,0 +1,24 @@
+# gunicorn の設定（gunicorn app:app で自動的に読み込まれる）
+import os
+
+# アプリをマスタープロセスで一度だけ読み込んでから fork する（ワーカーの起動が速く、メモリも共有される）
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+# app.py が関数の中で import する重いモジュールも、マスタープロセスで先に読み込んでおく
+# （fork 後のワーカーで共有されるので、各ワーカーの最初のアップロードなどが遅くならない）
+preload_modules = [
+    name for name in os.environ.get('GUNICORN_PRELOAD_MODULES', 'pandas,gspread').split(',') if name
+]
+
+
+def on_starting(server):
+    """ワーカーを起動する前に、マスタープロセスでテーブル作成・スキーマ変更を一度だけ行う"""
+    import importlib
+
+    import app
+
+    app.ensure_db_schema()
+    for name in preload_modules:
+        importlib.import_module(name)
@@ -0,0 +1,81 @@
+"""テスト共通の準備
+
+DB・アップロード先・マスタデータのキャッシュはテストごとの一時ディレクトリに置き、
+Googleスプレッドシートは bench/fake_sheets.py の偽のバックエンドに差し替える。
+"""
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'bench'))
+
+import app as app_module  # noqa: E402
+import fake_sheets  # noqa: E402
+import synthetic  # noqa: E402
+
+PRODUCT_NAMES = sorted(set(app_module.PRODUCT_NAME_MAPPING.values()))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """一時ディレクトリのDBでスキーマを作り、アプリケーションコンテキストの中で app モジュールを返す"""
+    config = app_module.app.config
+    monkeypatch.setitem(config, 'DATABASE', str(tmp_path / 'test.db'))
+    monkeypatch.setitem(config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setitem(config, 'MASTER_DATA_CACHE_FILE', str(tmp_path / 'master_data_cache.json'))
+    monkeypatch.setitem(config, 'SYNC_WORKER_ENABLED', False)
+    os.makedirs(config['UPLOAD_FOLDER'])
+    monkeypatch.setitem(app_module._db_schema, 'ready', False)
+    app_module.ensure_db_schema()
+    app_module._master_data.update(values=None, fetched_at=0.0, version=None, disk_loaded=False)
+    app_module._product_mapping_cache.update(version=None, mapping={})
+    with app_module.app.app_context():
+        yield app_module
+
+
+@pytest.fixture
+def sheets(app):
+    """出庫情報30件の偽のスプレッドシート（FakeSheetsBackend）"""
+    values, _ = synthetic.ledger_sheets(30, PRODUCT_NAMES, rows_per_day=10)
+    backend = fake_sheets.FakeSheetsBackend(values)
+    fake_sheets.install(app, backend)
+    return backend
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+
+def drain_sync_jobs(app):
+    """実行可能なジョブがなくなるまで、このスレッドで順に実行する"""
+    while (job := app.claim_sync_job()) is not None:
+        app.run_sync_job(job)
+
+
+def sheet_rows(backend, sheet_name):
+    """偽のシートのヘッダーを除いた行を [(行番号, 行), ...] で返す"""
+    rows = backend.spreadsheet.worksheets[sheet_name].rows
+    return [(row_number, row) for row_number, row in enumerate(rows[1:], start=2) if row and row[0]]
+
+
+def assert_mirror_matches_sheet(app, backend):
+    """ミラーの行番号と内容が偽のシートと一致することを確かめる"""
+    db = app.get_db()
+    info = [
+        (row['row_number'], [row['shukko_id'], row['shukko_date'], row['destination'], row['client'], row['staff']])
+        for row in db.execute(
+            'SELECT * FROM shukko_info_mirror WHERE row_number IS NOT NULL ORDER BY row_number'
+        )
+    ]
+    details = [
+        (row['row_number'], [row['shukko_id'], row['product_name'], row['quantity']])
+        for row in db.execute(
+            'SELECT * FROM shukko_detail_mirror WHERE row_number IS NOT NULL ORDER BY row_number'
+        )
+    ]
+    assert info == [(n, [str(v) for v in app._pad_row(row, 5)]) for n, row in sheet_rows(backend, '出庫情報')]
+    assert details == [(n, [str(v) for v in app._pad_row(row, 3)]) for n, row in sheet_rows(backend, '出庫詳細')]
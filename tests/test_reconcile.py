@@ -0,0 +1,124 @@
+"""売上データ（alcohol_sales）と出庫台帳の突き合わせ"""
+import pytest
+
+from conftest import assert_mirror_matches_sheet, drain_sync_jobs, sheet_rows
+
+DATE_FROM = '2025-06-01'
+DATE_TO = '2025-06-30'
+
+
+def import_sales(app, filename, rows):
+    """取り込み（store_sales_rows）と同じく alcohol_sales に登録し、追記ジョブを実行する"""
+    rows = [(date, product_name, count, filename) for date, product_name, count in rows]
+    db = app.get_db()
+    with db:
+        _, inserted_rows = app.store_sales_rows(db, filename, rows)
+        app.enqueue_sync_job('sales', {'rows': [list(row) for row in inserted_rows]})
+    drain_sync_jobs(app)
+
+
+def delete_local_sales(app, filename):
+    db = app.get_db()
+    with db:
+        db.execute('DELETE FROM alcohol_sales WHERE source_filename = ?', (filename,))
+
+
+def ledger_lines(backend, date):
+    """出庫日が date の出庫の出庫詳細を [(商品名, 数量), ...] で返す"""
+    ids = {row[0] for _, row in sheet_rows(backend, '出庫情報') if row[1] == date}
+    return sorted((row[1], row[2]) for _, row in sheet_rows(backend, '出庫詳細') if row[0] in ids)
+
+
+@pytest.fixture
+def sales(app, sheets):
+    """6月1日・2日の売上を取り込み、出庫台帳にも追記した状態（同じ内容の行を別ファイルにも持つ）"""
+    import_sales(app, '20250601-uriage.csv', [
+        ('2025-06-01', 'ワイン／フル2025', 2),
+        ('2025-06-01', '洋梨／フル2025', 3),
+    ])
+    import_sales(app, '20250601-uriage2.csv', [('2025-06-01', 'ワイン／フル2025', 2)])
+    import_sales(app, '20250602-uriage.csv', [('2025-06-02', 'ワイン／フル2025', 4)])
+    return sheets
+
+
+def test_ledger_written_by_the_sales_job_matches_the_sales(app, sales):
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO)
+
+    assert report['local_rows'] == report['sheet_rows'] == report['matched'] == 4
+    assert report['missing_in_sheet'] == []
+    assert report['extra_in_sheet'] == []
+    assert report['applied'] is None
+
+
+def test_rows_are_compared_as_a_multiset(app, sales):
+    # 同じ (販売日, 商品名, 数量) の売上が2件あり、片方のファイル分だけ消した
+    delete_local_sales(app, '20250601-uriage2.csv')
+    db = app.get_db()
+    with db:
+        app.store_sales_rows(db, 'manual.csv', [('2025-06-03', '洋梨／フル2025', 5, 'manual.csv')])
+
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO)
+    assert report['matched'] == 3
+    assert [(row['date'], row['product_name'], row['quantity']) for row in report['missing_in_sheet']] == [
+        ('2025-06-03', '洋梨／フル2025', 5)
+    ]
+    assert [(row['date'], row['product_name'], row['quantity']) for row in report['extra_in_sheet']] == [
+        ('2025-06-01', 'ワイン／フル2025', 2)
+    ]
+
+
+def test_manually_registered_ledger_rows_are_ignored(app, sales, client):
+    client.post('/register', data={
+        'date': '2025-06-02', 'destination': app.SALES_LEDGER_DESTINATION, 'client': '',
+        'staff': app.SALES_LEDGER_STAFF, 'item1': '洋梨／フル2025', 'qty1': '1',
+    })
+    drain_sync_jobs(app)
+
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO)
+    assert report['extra_in_sheet'] == []
+    assert report['ignored_in_sheet'] == 1
+
+
+def test_delete_extra_requires_a_date_range(app, sales, client):
+    with pytest.raises(ValueError):
+        app.reconcile_sales_ledger(DATE_FROM, '', delete_extra=True)
+    assert client.post('/reconcile', data={'delete_extra': '1'}).status_code == 400
+
+
+def test_delete_extra_removes_only_ledger_rows_created_from_sales(app, sales, client):
+    client.post('/register', data={
+        'date': '2025-06-02', 'destination': app.SALES_LEDGER_DESTINATION, 'client': '',
+        'staff': app.SALES_LEDGER_STAFF, 'item1': 'ワイン／フル2025', 'qty1': '4',
+    })
+    drain_sync_jobs(app)
+    delete_local_sales(app, '20250602-uriage.csv')
+    info_before = len(sheet_rows(sales, '出庫情報'))
+
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO, delete_extra=True)
+    assert report['applied'] == {'job_id': None, 'deleted': 1}
+    # 売上から作った出庫は出庫情報の行ごと消え、同じ内容の手動登録の出庫は残る
+    assert ledger_lines(sales, '2025-06-02') == [('ワイン／フル2025', '4')]
+    assert len(sheet_rows(sales, '出庫情報')) == info_before - 1
+    assert_mirror_matches_sheet(app, sales)
+
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO)
+    assert report['extra_in_sheet'] == []
+    assert report['ignored_in_sheet'] == 1
+
+
+def test_apply_appends_the_missing_sales_once_the_job_runs(app, sales):
+    db = app.get_db()
+    with db:
+        app.store_sales_rows(db, 'manual.csv', [('2025-06-03', '洋梨／フル2025', 5, 'manual.csv')])
+
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO, apply=True)
+    assert report['applied']['job_id'] is not None
+    # 追記ジョブが終わるまでは差分が確定しないので、続けて適用はできない
+    with pytest.raises(app.ReconcileConflict):
+        app.reconcile_sales_ledger(DATE_FROM, DATE_TO, apply=True)
+
+    drain_sync_jobs(app)
+    assert ledger_lines(sales, '2025-06-03') == [('洋梨／フル2025', '5')]
+    report = app.reconcile_sales_ledger(DATE_FROM, DATE_TO)
+    assert report['missing_in_sheet'] == []
+    assert report['matched'] == 5
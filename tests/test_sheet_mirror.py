@@ -0,0 +1,113 @@
+"""出庫シートのローカルミラー（行の削除・挿入後の行番号の付け直し）"""
+from conftest import assert_mirror_matches_sheet, sheet_rows
+
+
+def detail_ids_with_lines(backend, count):
+    """出庫詳細が count 行ある出庫IDを返す"""
+    counts = {}
+    for _, row in sheet_rows(backend, '出庫詳細'):
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    return [shukko_id for shukko_id, n in counts.items() if n == count]
+
+
+def test_refresh_copies_both_sheets_with_their_row_numbers(app, sheets):
+    assert app.refresh_sheet_mirror()
+    assert_mirror_matches_sheet(app, sheets)
+    assert not app.refresh_sheet_mirror()
+
+
+def test_mirror_delete_rows_shifts_the_rows_below_each_deleted_range(app, sheets):
+    app.refresh_sheet_mirror()
+    info = dict(sheet_rows(sheets, '出庫情報'))
+    details = dict(sheet_rows(sheets, '出庫詳細'))
+    deleted = {
+        '出庫情報': {n: info[n][0] for n in (3, 4, 10)},
+        '出庫詳細': {n: details[n][0] for n in (2, 7, 8, 9)},
+    }
+
+    app.mirror_delete_rows(deleted)
+    for sheet_name, ids_by_row in deleted.items():
+        for row_number in sorted(ids_by_row, reverse=True):
+            del sheets.spreadsheet.worksheets[sheet_name].rows[row_number - 1]
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_delete_shukko_records_removes_the_rows_from_the_sheet_and_the_mirror(app, sheets):
+    app.refresh_sheet_mirror()
+    shukko_ids = [row[0] for _, row in sheet_rows(sheets, '出庫情報')][2:5] + ['200101-010']
+
+    assert app.delete_shukko_records(shukko_ids) == 4
+    remaining = {row[0] for _, row in sheet_rows(sheets, '出庫情報') + sheet_rows(sheets, '出庫詳細')}
+    assert not remaining & set(shukko_ids)
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_delete_shukko_records_retries_once_after_refreshing_a_stale_mirror(app, sheets):
+    app.refresh_sheet_mirror()
+    # ミラーを取った後に、他の誰かがシートの先頭の出庫を削除した
+    info_rows = sheets.spreadsheet.worksheets['出庫情報'].rows
+    first_id = info_rows[1][0]
+    del info_rows[1]
+    target = info_rows[5][0]
+
+    assert app.delete_shukko_records([target]) == 1
+    remaining = {row[0] for _, row in sheet_rows(sheets, '出庫情報')}
+    assert first_id not in remaining and target not in remaining
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_mirror_insert_detail_rows_shifts_the_rows_below(app, sheets):
+    app.refresh_sheet_mirror()
+    rows = [['200101-003', 'ワイン／フル2025', '4'], ['200101-003', '洋梨／フル2025', '5']]
+
+    app.mirror_insert_detail_rows(6, rows)
+    sheets.spreadsheet.worksheets['出庫詳細'].rows[6:6] = rows
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def edit_details(app, client, shukko_id, lines):
+    """出庫詳細の編集フォームを開いたときのトークンで、lines の内容に更新する"""
+    current = app.mirror_find_details(shukko_id)
+    token = app.detail_lines_token([(row['product_name'], row['quantity']) for row in current])
+    form = {'token': token, 'line_count': len(lines)}
+    for i, (name, quantity) in enumerate(lines, start=1):
+        form[f'item{i}'] = name
+        form[f'qty{i}'] = quantity
+    return client.post(f'/edit-detail/{shukko_id}', data=form)
+
+
+def test_edit_detail_inserts_lines_below_the_last_line(app, sheets, client):
+    app.refresh_sheet_mirror()
+    shukko_id = detail_ids_with_lines(sheets, 1)[0]
+    line = [(row[1], row[2]) for _, row in sheet_rows(sheets, '出庫詳細') if row[0] == shukko_id]
+
+    response = edit_details(app, client, shukko_id, line + [('洋梨／フル2025', '6'), ('ワイン／フル2025', '7')])
+    assert response.status_code == 200
+    lines = [row[1:] for _, row in sheet_rows(sheets, '出庫詳細') if row[0] == shukko_id]
+    assert lines == [list(line[0]), ['洋梨／フル2025', '6'], ['ワイン／フル2025', '7']]
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_edit_detail_updates_and_deletes_lines(app, sheets, client):
+    app.refresh_sheet_mirror()
+    shukko_id = detail_ids_with_lines(sheets, 3)[0]
+
+    response = edit_details(app, client, shukko_id, [('洋梨／フル2025', '9')])
+    assert response.status_code == 200
+    lines = [row[1:] for _, row in sheet_rows(sheets, '出庫詳細') if row[0] == shukko_id]
+    assert lines == [['洋梨／フル2025', '9']]
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_edit_detail_rejects_a_form_opened_before_the_sheet_changed(app, sheets, client):
+    app.refresh_sheet_mirror()
+    shukko_id = detail_ids_with_lines(sheets, 2)[0]
+    current = app.mirror_find_details(shukko_id)
+    token = app.detail_lines_token([(row['product_name'], row['quantity']) for row in current])
+    sheets.spreadsheet.worksheets['出庫詳細'].rows[current[0]['row_number'] - 1][2] = '99'
+
+    response = client.post(f'/edit-detail/{shukko_id}', data={
+        'token': token, 'line_count': 1, 'item1': '洋梨／フル2025', 'qty1': '1',
+    })
+    assert response.status_code == 409
+    assert_mirror_matches_sheet(app, sheets)
@@ -0,0 +1,125 @@
+"""スプレッドシート反映ジョブのキュー（取り出し・再試行・途中からの再開）"""
+import json
+
+import fake_sheets
+
+from conftest import assert_mirror_matches_sheet, drain_sync_jobs, sheet_rows
+
+SALES_ROWS = [[f'2025-06-0{day}', 'ワイン／フル2025', day, '20250601-uriage.csv'] for day in range(1, 6)]
+
+
+def failing_append(monkeypatch, fail_calls):
+    """偽のシートの append_rows を、fail_calls 回目（1始まり）の呼び出しだけ失敗させる"""
+    original = fake_sheets.FakeWorksheet.append_rows
+    calls = {'count': 0}
+
+    def append_rows(self, values, **kwargs):
+        calls['count'] += 1
+        if calls['count'] in fail_calls:
+            raise RuntimeError('append failed')
+        return original(self, values, **kwargs)
+
+    monkeypatch.setattr(fake_sheets.FakeWorksheet, 'append_rows', append_rows)
+
+
+def job_row(app, job_id):
+    return app.get_db().execute('SELECT * FROM sync_jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def make_runnable(app, job_id):
+    """再試行までの待ち時間を飛ばす"""
+    db = app.get_db()
+    with db:
+        db.execute('UPDATE sync_jobs SET run_after = 0 WHERE id = ?', (job_id,))
+
+
+def test_claimed_job_is_not_claimed_again_until_its_lease_expires(app, sheets):
+    job_id = app.enqueue_sync_job('sales', {'rows': SALES_ROWS})
+
+    job = app.claim_sync_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 1
+    assert app.claim_sync_job() is None
+
+    db = app.get_db()
+    with db:
+        db.execute('UPDATE sync_jobs SET locked_until = 0 WHERE id = ?', (job_id,))
+    reclaimed = app.claim_sync_job()
+    assert reclaimed['id'] == job_id
+    assert reclaimed['attempts'] == 2
+    assert reclaimed['claim_token'] != job['claim_token']
+
+
+def test_worker_whose_lease_expired_does_not_write_or_finish_the_job(app, sheets):
+    job_id = app.enqueue_sync_job('sales', {'rows': SALES_ROWS})
+    stale = app.claim_sync_job()
+    db = app.get_db()
+    with db:
+        db.execute('UPDATE sync_jobs SET locked_until = 0 WHERE id = ?', (job_id,))
+    current = app.claim_sync_job()
+    info_before = len(sheet_rows(sheets, '出庫情報'))
+
+    app.run_sync_job(stale)
+    assert len(sheet_rows(sheets, '出庫情報')) == info_before
+    assert job_row(app, job_id)['status'] == 'running'
+
+    app.run_sync_job(current)
+    assert job_row(app, job_id)['status'] == 'done'
+    assert len(sheet_rows(sheets, '出庫情報')) == info_before + len(SALES_ROWS)
+
+
+def test_failed_chunk_is_retried_from_the_recorded_progress(app, sheets, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'SHEETS_WRITE_CHUNK_SIZE', 2)
+    info_before = len(sheet_rows(sheets, '出庫情報'))
+    detail_before = len(sheet_rows(sheets, '出庫詳細'))
+    failing_append(monkeypatch, fail_calls={2})
+    job_id = app.enqueue_sync_job('sales', {'rows': SALES_ROWS})
+
+    app.run_sync_job(app.claim_sync_job())
+    job = job_row(app, job_id)
+    assert job['status'] == 'pending'
+    assert job['last_error'] == 'append failed'
+    assert len(json.loads(job['payload'])['info_row_numbers']) == 2
+
+    make_runnable(app, job_id)
+    drain_sync_jobs(app)
+    assert job_row(app, job_id)['status'] == 'done'
+    info_ids = [row[0] for _, row in sheet_rows(sheets, '出庫情報')[info_before:]]
+    assert len(info_ids) == len(set(info_ids)) == len(SALES_ROWS)
+    assert len(sheet_rows(sheets, '出庫詳細')) == detail_before + len(SALES_ROWS)
+
+    # 再開したジョブの行番号は使わず、ミラーは取り直してシートと一致させる
+    app.refresh_sheet_mirror()
+    assert_mirror_matches_sheet(app, sheets)
+
+
+def test_failed_job_can_be_requeued_from_the_jobs_endpoint(app, sheets, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'SYNC_JOB_MAX_ATTEMPTS', 1)
+    failing_append(monkeypatch, fail_calls={1})
+    job_id = app.enqueue_sync_job('sales', {'rows': SALES_ROWS})
+    app.run_sync_job(app.claim_sync_job())
+    assert job_row(app, job_id)['status'] == 'failed'
+
+    response = client.post(f'/jobs/{job_id}/retry')
+    assert response.status_code == 200
+    assert response.json['status'] == 'pending'
+    assert response.json['attempts'] == 0
+    assert client.post(f'/jobs/{job_id}/retry').status_code == 409
+    assert client.post('/jobs/9999/retry').status_code == 404
+
+    drain_sync_jobs(app)
+    assert job_row(app, job_id)['status'] == 'done'
+
+
+def test_register_job_assigns_sheet_row_numbers_to_the_pending_mirror_rows(app, sheets, client):
+    client.get('/list')
+    response = client.post('/register', data={
+        'date': '2025-06-10', 'destination': 'A店', 'client': '', 'staff': '北沢',
+        'item1': 'ワイン／フル2025', 'qty1': '2', 'item2': '洋梨／フル2025', 'qty2': '3',
+    })
+    assert response.status_code == 200
+    pending = app.get_db().execute('SELECT COUNT(*) FROM shukko_detail_mirror WHERE row_number IS NULL').fetchone()
+    assert pending[0] == 2
+
+    drain_sync_jobs(app)
+    assert_mirror_matches_sheet(app, sheets)